@@ -0,0 +1,83 @@
+"""Microbenchmark: per-activity time helpers (previous implementation) vs. per-train ETAs.
+
+Times the clock work of one periodic cycle: producing tempoProssimaStazione
+(and, for Italo, orarioUltimoRilevamento) for every subscribed activity. The
+previous implementation re-parsed the "HH:MM" strings with strptime and built
+fixed-offset timezones for every activity; now each train's next-stop ETA is
+resolved once per upstream document into epoch milliseconds with Europe/Rome
+zoneinfo, and every countdown is integer arithmetic against the cycle's clock.
+Trains are split evenly between Trenitalia and Italo.
+
+Run from the repository root:
+
+    python benchmarks/bench_eta.py [riders per train]
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("ACTIVITY_STORE", "memory")
+
+from bench_parsers import add_minutes, how_much_italo, how_much_trenitalia, time_to_millis
+from server import now_millis, parse_italo, parse_trenitalia
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+SIZES = (1_000, 10_000, 100_000)
+
+
+# Previous implementation: the time fields worked out again for every activity
+def legacy_trenitalia_times(train_data):
+    ritardo = train_data.get("ritardo")
+    for d in train_data["fermate"]:
+        if d.get("partenzaReale") is None:
+            scheduled = d.get("arrivo_teorico") or d.get("partenza_teorica")
+            return how_much_trenitalia(add_minutes(scheduled, ritardo)) if scheduled is not None else 0
+
+def legacy_italo_times(data):
+    schedule = data["TrainSchedule"]
+    delay = schedule["Distruption"]["DelayAmount"] or 0
+    time_to_millis(data["LastUpdate"])
+    for stop in schedule["StazioniNonFerme"]:
+        if stop.get("EstimatedArrivalTime", "01:00") != "01:00":
+            return how_much_italo(add_minutes(stop["EstimatedArrivalTime"], delay))
+        if stop.get("EstimatedDepartureTime", "01:00") != "01:00":
+            return how_much_italo(add_minutes(stop["EstimatedDepartureTime"], delay))
+
+def legacy_cycle(trains, riders):
+    for document, legacy_times, _ in trains:
+        for _ in range(riders):
+            legacy_times(document)
+
+
+def cycle(trains, riders):
+    now_ms = now_millis()
+    for document, _, parse in trains:
+        # Each poll brings a new document, so the schedule is parsed every cycle
+        snapshot = parse(document, now_ms).countdown(now_ms)
+        for _ in range(riders):
+            snapshot.tempoProssimaStazione
+
+
+def main():
+    riders = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    with open(os.path.join(FIXTURES, "andamentoTreno_9544.json")) as f:
+        trenitalia = json.load(f)
+    with open(os.path.join(FIXTURES, "RicercaTrenoService_8901.json")) as f:
+        italo = json.load(f)
+    providers = ((trenitalia, legacy_trenitalia_times, parse_trenitalia), (italo, legacy_italo_times, parse_italo))
+
+    print(f"Clock work per cycle, {riders} riders per train")
+    for activities in SIZES:
+        trains = [providers[i % 2] for i in range(max(1, activities // riders))]
+        results = {}
+        for label, func in (("per-activity", legacy_cycle), ("per-train", cycle)):
+            number = 1 if activities >= 100_000 else 3
+            results[label] = min(timeit.repeat(lambda: func(trains, riders), number=number, repeat=3)) / number
+        print(f"  {activities:>7} activities  per-activity {results['per-activity'] * 1e3:9.2f} ms"
+              f"  per-train {results['per-train'] * 1e3:8.2f} ms"
+              f"  speedup {results['per-activity'] / results['per-train']:6.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Memory per activity: full TrainUpdate dicts (previous implementation) vs. compact records.
+
+Loads N activities spread over trains of RIDERS_PER_TRAIN riders each, every
+one decoded from its own JSON request body as the update endpoints do, and
+measures the memory held by the activity map and its per-train index with
+tracemalloc. The previous implementation kept each body's dict; the store now
+keeps one ActivityRecord per rider pointing at a TrainState interned per train.
+
+Run from the repository root:
+
+    python benchmarks/bench_memory.py [riders_per_train]
+"""
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("ACTIVITY_STORE", "memory")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from server import ActivityStore, MemoryBackend
+
+SIZES = (10_000, 100_000)
+
+
+def request_body(index, riders_per_train, now_ms):
+    train = index // riders_per_train
+    return json.dumps({
+        "push_token": f"{index:064x}", "ritardo": 5, "problemi": "", "programmato": True, "tracciato": True,
+        "prossimaStazione": "FIRENZE SANTA MARIA NOVELLA", "prossimoBinario": "8", "tempoProssimaStazione": 12,
+        "stazioneUltimoRilevamento": "BOLOGNA CENTRALE", "orarioUltimoRilevamento": now_ms,
+        "stazionePartenza": "MILANO CENTRALE", "orarioPartenza": now_ms - 3600_000,
+        "stazioneArrivo": "ROMA TERMINI", "orarioArrivo": now_ms + 7200_000,
+        "train_id": f"trip-{index}", "seat": f"{index % 80}{'ABCD'[index % 4]}",
+        "dataPartenza": now_ms - 3600_000, "dataArrivo": now_ms + 7200_000,
+        "numeroTreno": str(9500 + train), "provider": "Trenitalia"
+    })
+
+
+def legacy_load(bodies):
+    activities = {}
+    by_train = {}
+    for body in bodies:
+        data = json.loads(body)
+        activities[data["push_token"]] = data
+        by_train.setdefault((data["provider"], data["numeroTreno"]), set()).add(data["push_token"])
+    return activities, by_train
+
+
+def compact_load(bodies):
+    store = ActivityStore(MemoryBackend())
+    for body in bodies:
+        data = json.loads(body)
+        store.put(data["push_token"], data)
+    return store
+
+
+def measure(load, bodies):
+    gc.collect()
+    tracemalloc.start()
+    held = load(bodies)
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del held
+    return size
+
+
+def main():
+    riders_per_train = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    now_ms = int(time.time() * 1000)
+    print(f"Activities spread over trains of {riders_per_train} riders")
+    for size in SIZES:
+        bodies = [request_body(i, riders_per_train, now_ms) for i in range(size)]
+        before = measure(legacy_load, bodies) / size
+        after = measure(compact_load, bodies) / size
+        print(f"  {size:>7} activities: dicts {before:7.0f} B/activity, records {after:7.0f} B/activity ({before / after:.2f}x smaller)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""Microbenchmark: per-field payload walks (previous implementation) vs. single-pass parsers.
+
+Run from the repository root:
+
+    python benchmarks/bench_parsers.py [iterations]
+"""
+import json
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("ACTIVITY_STORE", "memory")
+
+from server import parse_italo, parse_trenitalia
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+# Previous time helpers: fixed UTC+1 wall clocks, re-parsed for every activity
+def add_minutes(time_str_or_millis, minutes_to_add: int) -> str:
+    try:
+        # If the input is an int or a string number, treat it as milliseconds
+        if isinstance(time_str_or_millis, int) or (isinstance(time_str_or_millis, str) and time_str_or_millis.isdigit()):
+            millis = int(time_str_or_millis)
+            date_obj = datetime.fromtimestamp(millis / 1000, tz=timezone.utc)  # Convert from UTC
+        else:
+            # Else, assume it's a "HH:MM" string
+            date_obj = datetime.strptime(time_str_or_millis, "%H:%M")
+        
+        # Adjust for local timezone (use datetime.timezone)
+        date_obj = date_obj.replace(tzinfo=timezone(timedelta(hours=1)))
+        
+        # Add the minutes
+        new_time = date_obj + timedelta(minutes=minutes_to_add)
+        
+        # Convert back to local timezone if necessary
+        new_time = new_time.astimezone(timezone(timedelta(hours=1)))
+        
+        # Return formatted time
+        return new_time.strftime("%H:%M")
+    except (ValueError, TypeError):
+        return None
+
+def how_much_trenitalia(to_time_str: str) -> int:
+    try:
+        # Get current time in minutes since midnight
+        now = datetime.now(timezone(timedelta(hours=0)))
+        current_minutes = now.hour * 60 + now.minute
+
+        # Parse the target time
+        target_hour, target_minute = map(int, to_time_str.split(":"))
+        target_minutes = target_hour * 60 + target_minute
+
+        # Calculate difference
+        difference = target_minutes - current_minutes
+        if difference < 0:
+            difference += 24 * 60  # handle next day case
+
+        return difference
+    except (ValueError, IndexError):
+        return None
+    
+def how_much_italo(to_time_str: str) -> int:
+    try:
+        # Get current time in minutes since midnight
+        now = datetime.now(timezone(timedelta(hours=1)))
+        current_minutes = now.hour * 60 + now.minute
+
+        # Parse the target time
+        target_hour, target_minute = map(int, to_time_str.split(":"))
+        target_minutes = target_hour * 60 + target_minute
+
+        # Calculate difference
+        difference = target_minutes - current_minutes
+        if difference < 0:
+            difference += 24 * 60  # handle next day case
+
+        return difference
+    except (ValueError, IndexError):
+        return None
+    
+def time_to_millis(time_str: str) -> int:
+    try:
+        # Get the current date
+        today = datetime.now().date()
+
+        # Parse the time string into a datetime object with today's date
+        time_obj = datetime.strptime(time_str, "%H:%M")
+        time_obj = time_obj.replace(year=today.year, month=today.month, day=today.day)
+
+        # Adjust for local timezone (use datetime.timezone)
+        time_obj = time_obj.replace(tzinfo=timezone(timedelta(hours=1)))
+        
+        # Convert to UTC time zone
+        time_obj = time_obj.astimezone(timezone.utc)
+        
+        # Get the Unix epoch (1970-01-01 00:00:00 UTC)
+        epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+        # Calculate the difference in seconds and convert to milliseconds
+        delta = time_obj - epoch
+        return int(delta.total_seconds() * 1000)
+    except ValueError:
+        return None
+
+
+# Previous implementation: each content-state field walks the payload on its own
+def legacy_parameter(parameter, train_data):
+    for v in train_data:
+        if v == parameter:
+            return train_data[v]
+
+def legacy_fermate_info(parameter, train_data):
+    fermate_database = legacy_parameter("fermate", train_data)
+    if parameter == "prossima_stazione":
+        for d in fermate_database:
+            if d.get("partenzaReale") is None:
+                return d.get("stazione")
+    elif parameter == "prossimo_binario":
+        for d in fermate_database:
+            if d.get("partenzaReale") is None:
+                for key in ("binarioEffettivoPartenzaDescrizione", "binarioProgrammatoPartenzaDescrizione",
+                            "binarioEffettivoArrivoDescrizione", "binarioProgrammatoArrivoDescrizione"):
+                    if d.get(key) is not None:
+                        return d.get(key)
+                return "-"
+    elif parameter == "tempo_prossima_stazione":
+        ritardo = legacy_parameter("ritardo", train_data)
+        for d in fermate_database:
+            if d.get("partenzaReale") is None:
+                if d.get("arrivo_teorico") is not None:
+                    return how_much_trenitalia(add_minutes(d.get("arrivo_teorico"), ritardo))
+                elif d.get("partenza_teorica") is not None:
+                    return how_much_trenitalia(add_minutes(d.get("partenza_teorica"), ritardo))
+                return 0
+
+def legacy_trenitalia(train_data):
+    return {
+        "stazioneUltimoRilevamento": legacy_parameter('stazioneUltimoRilevamento', train_data),
+        "orarioUltimoRilevamento": legacy_parameter('oraUltimoRilevamento', train_data),
+        "ritardo": legacy_parameter('ritardo', train_data),
+        "prossimaStazione": legacy_fermate_info("prossima_stazione", train_data),
+        "prossimoBinario": legacy_fermate_info("prossimo_binario", train_data),
+        "tempoProssimaStazione": legacy_fermate_info("tempo_prossima_stazione", train_data),
+    }
+
+def legacy_parameter_italo(parameter, data):
+    if parameter == "stazioneUltimoRilevamento":
+        return ""
+    if parameter == "orarioUltimoRilevamento":
+        for dict in data:
+            if dict == "LastUpdate":
+                return time_to_millis(data[dict])
+    elif parameter == "ritardo":
+        for dict in data:
+            if dict == "TrainSchedule":
+                for key in data[dict]:
+                    if key == "Distruption":
+                        for keyy in data[dict][key]:
+                            if keyy == "DelayAmount":
+                                return data[dict][key][keyy]
+    elif parameter == "prossimaStazione":
+        for dict in data:
+            if dict == "TrainSchedule":
+                for key in data[dict]:
+                    if key == "StazioniNonFerme":
+                        for dictt in data[dict][key]:
+                            for keyy in dictt:
+                                if keyy == "LocationDescription":
+                                    return dictt[keyy]
+    elif parameter == "prossimoBinario":
+        for dict in data:
+            if dict == "TrainSchedule":
+                for key in data[dict]:
+                    if key == "StazioniNonFerme":
+                        for dictt in data[dict][key]:
+                            for keyy in dictt:
+                                if keyy == "ActualArrivalPlatform":
+                                    return dictt[keyy] if dictt[keyy] is not None else "-"
+    elif parameter == "tempoProssimaStazione":
+        delay = legacy_parameter_italo("ritardo", data) or 0
+        for dict in data:
+            if dict == "TrainSchedule":
+                for key in data[dict]:
+                    if key == "StazioniNonFerme":
+                        for dictt in data[dict][key]:
+                            for keyy in dictt:
+                                if keyy == "EstimatedArrivalTime" and dictt[keyy] != "01:00":
+                                    return how_much_italo(add_minutes(dictt[keyy], delay))
+                            for keyy in dictt:
+                                if keyy == "EstimatedDepartureTime" and dictt[keyy] != "01:00":
+                                    return how_much_italo(add_minutes(dictt[keyy], delay))
+
+def legacy_italo(data):
+    return {field: legacy_parameter_italo(field, data) for field in (
+        "stazioneUltimoRilevamento", "orarioUltimoRilevamento", "ritardo",
+        "prossimaStazione", "prossimoBinario", "tempoProssimaStazione")}
+
+
+TIME_FIELDS = ("tempoProssimaStazione", "orarioUltimoRilevamento")
+
+def bench(label, func, payload, iterations):
+    seconds = min(timeit.repeat(lambda: func(payload), number=iterations, repeat=5))
+    per_call = seconds / iterations * 1e6
+    print(f"  {label:<12} {per_call:8.2f} us/snapshot")
+    return per_call
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    with open(os.path.join(FIXTURES, "andamentoTreno_9544.json")) as f:
+        trenitalia = json.load(f)
+    with open(os.path.join(FIXTURES, "RicercaTrenoService_8901.json")) as f:
+        italo = json.load(f)
+
+    for name, payload, legacy, parser in (
+        ("Trenitalia andamentoTreno", trenitalia, legacy_trenitalia, parse_trenitalia),
+        ("Italo RicercaTrenoService", italo, legacy_italo, parse_italo),
+    ):
+        # The time fields differ on purpose: the legacy helpers assumed UTC+1 all year
+        expected, actual = legacy(payload), parser(payload).as_dict()
+        for field in TIME_FIELDS:
+            del expected[field], actual[field]
+        assert expected == actual, f"{name}: parsers disagree"
+        print(f"{name} ({iterations} iterations)")
+        before = bench("per-field", legacy, payload, iterations)
+        after = bench("single-pass", lambda p: parser(p).as_dict(), payload, iterations)
+        print(f"  speedup      {before / after:8.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Microbenchmark: per-token dict payloads (previous implementation) vs. pre-encoded fragments.
+
+Fans one train snapshot out to N activities the way a periodic cycle does,
+counting the work done per token: building the content-state, the two change
+detection digests and the payload body. The previous implementation copied the
+activity dict, merged the snapshot in, hashed it with json.dumps and let httpx
+encode the payload dict; now the train part is encoded once per poll, the
+activity part once per activity record, and only the timestamp is spliced in
+per push.
+
+Run from the repository root:
+
+    python benchmarks/bench_payloads.py [tokens]
+"""
+import hashlib
+import json
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("ACTIVITY_STORE", "memory")
+
+import server
+from server import ActivityRecord, COSMETIC_FIELDS, UPDATE_PAYLOAD_EXTRA, ContentState, encode_payload, encode_snapshot, parse_trenitalia
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def activity(index):
+    now = int(time.time() * 1000)
+    return {
+        "push_token": f"{index:064x}", "ritardo": 0, "problemi": "", "programmato": True, "tracciato": True,
+        "prossimaStazione": "MILANO CENTRALE", "prossimoBinario": "-", "tempoProssimaStazione": 0,
+        "stazioneUltimoRilevamento": "", "orarioUltimoRilevamento": now, "stazionePartenza": "MILANO CENTRALE",
+        "orarioPartenza": now, "stazioneArrivo": "ROMA TERMINI", "orarioArrivo": now + 3 * 3600 * 1000,
+        "train_id": "bench", "seat": f"{index % 20}A", "dataPartenza": now, "dataArrivo": now + 3 * 3600 * 1000,
+        "numeroTreno": "9544", "provider": "Trenitalia"
+    }
+
+
+# Previous implementation
+def legacy_digests(content_state):
+    meaningful = {k: v for k, v in content_state.items() if k not in COSMETIC_FIELDS}
+    cosmetic = [content_state.get(k) for k in COSMETIC_FIELDS]
+    return (
+        hashlib.sha1(json.dumps(meaningful, sort_keys=True, default=str).encode()).hexdigest(),
+        hashlib.sha1(json.dumps(cosmetic, default=str).encode()).hexdigest()
+    )
+
+def legacy_fan_out(activities, snapshot):
+    for data in activities.values():
+        content_state = data.copy()
+        del content_state["push_token"]
+        content_state.update(snapshot.as_dict())
+        legacy_digests(content_state)
+        payload = {"aps": {"timestamp": int(time.time()), "event": "update",
+                           "content-state": content_state, "relevance-score": 100.0}}
+        json.dumps(payload).encode()
+
+
+def fan_out(records, snapshot):
+    encoded_snapshot = encode_snapshot(snapshot.as_dict())
+    for record in records.values():
+        content_state = ContentState(record.fragment(), *encoded_snapshot)
+        content_state.digests()
+        encode_payload("update", int(time.time()), content_state, UPDATE_PAYLOAD_EXTRA)
+
+
+def main():
+    tokens = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    with open(os.path.join(FIXTURES, "andamentoTreno_9544.json")) as f:
+        snapshot = parse_trenitalia(json.load(f))
+    activities = {data["push_token"]: data for data in map(activity, range(tokens))}
+    records = {token: ActivityRecord(data) for token, data in activities.items()}
+
+    print(f"Fan-out of one train to {tokens} tokens (JSON backend: {'orjson' if server.orjson else 'stdlib'})")
+    results = {}
+    for label, func, state in (("per-token", legacy_fan_out, activities), ("pre-encoded", fan_out, records)):
+        seconds = min(timeit.repeat(lambda: func(state, snapshot), number=5, repeat=5)) / 5
+        results[label] = seconds / tokens * 1e6
+        print(f"  {label:<12} {results[label]:8.2f} us/push")
+    print(f"  speedup      {results['per-token'] / results['pre-encoded']:8.2f}x")
+
+if __name__ == "__main__":
+    main()
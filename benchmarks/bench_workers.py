@@ -0,0 +1,214 @@
+"""Load test for sharded multi-worker mode against real uvicorn workers.
+
+For every worker count it starts benchmarks/mocks.py and `uvicorn --workers N`
+with SHARDED_WORKERS=1 on one shared SQLite store, then:
+
+1. registers N push tokens through /register-token and starts their live
+   activities through /update-train-activity. The kernel hands each
+   connection to any worker, so most updates land on a worker that did not
+   take the registration and must find the token through the read-through
+   lookup (or the sync loop); an update failing with "Token not found" is
+   one whose registration was not yet flushed to the store,
+2. leaves the workers polling for a while and checks on the upstream mock that
+   every train was polled, and by one worker only (a train polled by two
+   owners shows up at about twice the median poll count),
+3. kills one worker with SIGKILL, so it never leaves the ring, and measures
+   how long the survivors take to drop it from the ring and to poll every
+   train it owned again.
+
+Worker ids and rings are read from /debug/cycle over fresh connections, which
+the kernel spreads across the workers. The activities are spread over one
+train per ACTIVITIES_PER_TRAIN tokens, one in five of them Italo.
+
+Run from the repository root:
+
+    python benchmarks/bench_workers.py [--workers 2,4] [--activities 2000] [--poll-interval 2] ...
+"""
+import argparse
+import asyncio
+import base64
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from loadtest import ACTIVITIES_PER_TRAIN, MOCKS, ROOT, activity, drive, free_port, request_row, wait_ready
+
+sys.path.insert(0, ROOT)
+os.environ.setdefault("ACTIVITY_STORE", "memory")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from server import HashRing
+
+
+async def worker_states(base, workers, attempts=200):
+    """Shard state of every worker answering on `base`, keyed by worker id."""
+    states = {}
+    # No keep-alive: every request is a new connection the kernel may give to another worker
+    async with httpx.AsyncClient(timeout=10, limits=httpx.Limits(max_keepalive_connections=0)) as client:
+        for _ in range(attempts):
+            shard = (await client.get(f"{base}/debug/cycle")).json()["shard"]
+            states[shard["worker_id"]] = shard
+            if len(states) >= workers:
+                break
+    return states
+
+
+async def train_polls(client, upstream):
+    return (await client.get(f"{upstream}/stats/trains")).json()
+
+
+async def run_workers(workers, args):
+    apns_port, upstream_port, server_port = free_port(), free_port(), free_port()
+    mock_cmd = [
+        sys.executable, MOCKS, "--apns-port", str(apns_port), "--upstream-port", str(upstream_port),
+        "--apns-latency", str(args.apns_latency), "--upstream-latency", str(args.upstream_latency)
+    ]
+    key = ec.generate_private_key(ec.SECP256R1())
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    tmp = tempfile.TemporaryDirectory()
+    env = dict(
+        os.environ,
+        APNS_AUTH_KEY=base64.b64encode(pem).decode(),
+        APNS_SCHEME="http",
+        APNS_HOST="127.0.0.1",
+        APNS_PORT=str(apns_port),
+        VIAGGIATRENO_BASE=f"http://127.0.0.1:{upstream_port}/viaggiatreno/",
+        ITALO_BASE=f"http://127.0.0.1:{upstream_port}/italo/",
+        ACTIVITY_STORE="sqlite",
+        ACTIVITY_STORE_PATH=os.path.join(tmp.name, "activities.db"),
+        SHARDED_WORKERS="1",
+        WORKER_HEARTBEAT=str(args.heartbeat),
+        WORKER_TTL=str(args.worker_ttl),
+        LOG_LEVEL="WARNING",
+        # A fixed cadence, so a train owned by two workers stands out at twice the polls
+        POLL_MIN_INTERVAL=str(args.poll_interval),
+        POLL_MAX_INTERVAL=str(args.poll_interval),
+        UPSTREAM_RATE_LIMIT="0",
+        MAX_BATCH_SIZE=str(max(args.activities, 5000))
+    )
+    server_cmd = [
+        sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(server_port),
+        "--workers", str(workers), "--log-level", "warning"
+    ]
+
+    mocks = subprocess.Popen(mock_cmd, cwd=ROOT)
+    server = subprocess.Popen(server_cmd, cwd=ROOT, env=env)
+    base = f"http://127.0.0.1:{server_port}"
+    upstream = f"http://127.0.0.1:{upstream_port}"
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    try:
+        async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+            await wait_ready(client, f"{upstream}/stats")
+            await wait_ready(client, f"{base}/health")
+            # Every worker must have joined the ring before the trains are split
+            deadline = time.monotonic() + 30
+            while True:
+                states = await worker_states(base, workers)
+                if len(states) == workers and all(len(state["workers"]) == workers for state in states.values()):
+                    break
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"{workers} workers did not form a ring: {states}")
+                await asyncio.sleep(args.heartbeat)
+            ring = HashRing(next(iter(states.values()))["workers"])
+
+            now_ms = int(time.time() * 1000)
+            activities = [activity(i, now_ms) for i in range(args.activities)]
+            trains = {f"{a['provider']}/{a['numeroTreno']}": a["numeroTreno"] for a in activities}
+            rows = []
+            latencies, failures, elapsed = await drive(
+                client, f"{base}/register-token",
+                [{"train_id": a["train_id"], "push_token": a["push_token"]} for a in activities], args.concurrency
+            )
+            rows.append(request_row("register-token", latencies, failures, elapsed))
+            latencies, failures, elapsed = await drive(client, f"{base}/update-train-activity", activities, args.concurrency)
+            rows.append(request_row("update-train-activity", latencies, failures, elapsed))
+
+            # Steady state: every train polled, and each by one worker
+            await asyncio.sleep(args.poll_interval * 2)
+            before = await train_polls(client, upstream)
+            await asyncio.sleep(args.periodic_seconds)
+            after = await train_polls(client, upstream)
+            counts = [after.get(train, 0) - before.get(train, 0) for train in trains]
+            median = statistics.median(counts)
+            steady = {
+                "trains": len(trains),
+                "unpolled": sum(1 for count in counts if count == 0),
+                "polls_median": median,
+                "polls_max": max(counts),
+                # Trains polled at least 1.5x the median are likely owned by two workers
+                "double_polled": sum(1 for count in counts if median and count >= 1.5 * median)
+            }
+
+            # Rebalance: kill one worker without letting it leave the ring
+            victim = sorted(states)[0]
+            orphans = [train for train, number in trains.items() if ring.owner(number) == victim]
+            at_kill = await train_polls(client, upstream)
+            os.kill(int(victim.rsplit("-", 1)[1]), signal.SIGKILL)
+            killed = time.perf_counter()
+            dropped = recovered = None
+            while dropped is None or recovered is None:
+                if time.perf_counter() - killed > args.worker_ttl * 4 + args.poll_interval * 4:
+                    break
+                if dropped is None:
+                    survivors = await worker_states(base, workers - 1)
+                    if all(victim not in state["workers"] for state in survivors.values()):
+                        dropped = time.perf_counter() - killed
+                if recovered is None:
+                    polls = await train_polls(client, upstream)
+                    if all(polls.get(train, 0) > at_kill.get(train, 0) for train in orphans):
+                        recovered = time.perf_counter() - killed
+                await asyncio.sleep(0.2)
+            rebalance = {
+                "orphaned_trains": len(orphans),
+                "ring_updated_s": None if dropped is None else round(dropped, 1),
+                "orphans_polled_s": None if recovered is None else round(recovered, 1)
+            }
+            return {"workers": workers, "requests": rows, "steady": steady, "rebalance": rebalance}
+    finally:
+        for process in (server, mocks):
+            process.terminate()
+            try:
+                process.wait(timeout=20)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        tmp.cleanup()
+
+
+def report(result):
+    print(f"\n== {result['workers']} workers ==")
+    print(f"{'stage':<24}{'requests':>10}{'failed':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for row in result["requests"]:
+        print(f"{row['stage']:<24}{row['requests']:>10}{row['failed']:>8}{row['per_second']:>10}{row['p50_ms']:>10}{row['p99_ms']:>10}")
+    for section in ("steady", "rebalance"):
+        print(f"{section}:")
+        for key, value in result[section].items():
+            print(f"  {key:<20}{value}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", default="2,4", help="comma separated worker counts")
+    parser.add_argument("--activities", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64, help="requests in flight against the server")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="POLL_MIN_INTERVAL of the workers")
+    parser.add_argument("--periodic-seconds", type=float, default=20.0, help="length of the steady-state window")
+    parser.add_argument("--heartbeat", type=float, default=0.5, help="WORKER_HEARTBEAT of the workers")
+    parser.add_argument("--worker-ttl", type=float, default=3.0, help="WORKER_TTL of the workers")
+    parser.add_argument("--apns-latency", type=float, default=0.02)
+    parser.add_argument("--upstream-latency", type=float, default=0.05)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(f"{args.activities} activities on {args.activities // ACTIVITIES_PER_TRAIN} trains, {os.cpu_count()} CPUs")
+    for workers in (int(w) for w in args.workers.split(",")):
+        report(asyncio.run(run_workers(workers, args)))
@@ -0,0 +1,339 @@
+"""End-to-end load test against local APNs and upstream stand-ins.
+
+For every size it starts benchmarks/mocks.py and a fresh server process wired
+to the mocks, then:
+
+1. registers N push tokens through /register-token,
+2. starts N live activities through /update-train-activity (one push each),
+3. leaves the periodic loop polling the trains for a while.
+
+and reports request latencies (p50/p99), pushes per second, trains fetched
+vs. tokens served, per-train poll time, APNs and upstream latencies from
+/metrics and /debug/cycle, and the server's RSS. The
+activities are spread over one train per ACTIVITIES_PER_TRAIN tokens, one in
+five of them Italo.
+
+Run from the repository root:
+
+    python benchmarks/loadtest.py [--sizes 100,1000,10000] [--periodic-seconds 20] [--apns-latency 0.02] ...
+
+Mock options (latency, error rates) are passed through to benchmarks/mocks.py;
+see `python benchmarks/mocks.py --help`.
+"""
+import argparse
+import asyncio
+import base64
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+MOCKS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mocks.py")
+
+ACTIVITIES_PER_TRAIN = 10
+MOCK_OPTIONS = (
+    "apns_latency", "apns_jitter", "apns_unregistered_rate", "apns_throttle_rate", "apns_error_rate",
+    "upstream_latency", "upstream_error_rate"
+)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def rss_mb(pid):
+    """Current and peak resident set size of a process, in MB."""
+    values = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith(("VmRSS:", "VmHWM:")):
+                key, value = line.split(":", 1)
+                values[key] = int(value.split()[0]) / 1024
+    return values.get("VmRSS"), values.get("VmHWM")
+
+
+def parse_metrics(text):
+    """Prometheus text format to {(name, frozenset(labels)): value}."""
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        series, value = line.rsplit(" ", 1)
+        labels = ()
+        if "{" in series:
+            series, label_text = series[:-1].split("{", 1)
+            labels = tuple(
+                (k, v.strip('"')) for k, v in (pair.split("=", 1) for pair in label_text.split(","))
+            )
+        samples[(series, frozenset(labels))] = float(value)
+    return samples
+
+
+def histogram(samples, name, **labels):
+    """Bucket counts, sum and count of a histogram, summed over series matching `labels`."""
+    buckets = {}
+    total = count = 0.0
+    wanted = set(labels.items())
+    for (series, series_labels), value in samples.items():
+        if not wanted <= series_labels:
+            continue
+        if series == name + "_bucket":
+            le = dict(series_labels)["le"]
+            bound = float("inf") if le == "+Inf" else float(le)
+            buckets[bound] = buckets.get(bound, 0) + value
+        elif series == name + "_sum":
+            total += value
+        elif series == name + "_count":
+            count += value
+    return buckets, total, count
+
+
+def histogram_delta(before, after):
+    buckets = {bound: value - before[0].get(bound, 0) for bound, value in after[0].items()}
+    return buckets, after[1] - before[1], after[2] - before[2]
+
+
+def histogram_quantile(hist, q):
+    """Linear interpolation inside the bucket holding quantile q, like PromQL's histogram_quantile."""
+    buckets, _, count = hist
+    if count <= 0:
+        return None
+    rank = q * count
+    previous_bound, previous_count = 0.0, 0.0
+    for bound in sorted(buckets):
+        cumulative = buckets[bound]
+        if cumulative >= rank:
+            if bound == float("inf"):
+                return previous_bound
+            in_bucket = cumulative - previous_count
+            fraction = (rank - previous_count) / in_bucket if in_bucket else 1.0
+            return previous_bound + (bound - previous_bound) * fraction
+        previous_bound, previous_count = bound, cumulative
+    return previous_bound
+
+
+def counter(samples, name, **labels):
+    wanted = set(labels.items())
+    return sum(value for (series, series_labels), value in samples.items() if series == name and wanted <= series_labels)
+
+
+def activity(index, now_ms):
+    train = index // ACTIVITIES_PER_TRAIN
+    italo = train % 5 == 4
+    return {
+        "push_token": f"{index:064x}",
+        "train_id": f"bench-{train}",
+        "ritardo": 0,
+        "problemi": "",
+        "programmato": True,
+        "tracciato": True,
+        "prossimaStazione": "MILANO CENTRALE",
+        "prossimoBinario": "-",
+        "tempoProssimaStazione": 0,
+        "stazioneUltimoRilevamento": "",
+        "orarioUltimoRilevamento": now_ms,
+        "stazionePartenza": "MILANO CENTRALE",
+        "orarioPartenza": now_ms - 10 * 60 * 1000,
+        "stazioneArrivo": "ROMA TERMINI",
+        "orarioArrivo": now_ms + 3 * 3600 * 1000,
+        "seat": None,
+        "dataPartenza": now_ms - 10 * 60 * 1000,
+        "dataArrivo": now_ms + 3 * 3600 * 1000,
+        "numeroTreno": str((8900 if italo else 9500) + train),
+        "provider": "Italo" if italo else "Trenitalia"
+    }
+
+
+async def drive(client, path, bodies, concurrency):
+    """POST every body with at most `concurrency` requests in flight; returns latencies (ms), failures and wall time."""
+    slots = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+
+    async def one(body):
+        nonlocal failures
+        async with slots:
+            started = time.perf_counter()
+            try:
+                response = await client.post(path, json=body)
+                ok = response.status_code == 200 and response.json().get("status") != "error"
+            except httpx.HTTPError:
+                ok = False
+            latencies.append((time.perf_counter() - started) * 1000)
+            if not ok:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(body) for body in bodies))
+    return latencies, failures, time.perf_counter() - started
+
+
+async def wait_ready(client, url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if (await client.get(url)).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"{url} did not come up within {timeout}s")
+        await asyncio.sleep(0.1)
+
+
+def request_row(name, latencies, failures, elapsed):
+    return {
+        "stage": name,
+        "requests": len(latencies),
+        "failed": failures,
+        "per_second": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 0.5), 1),
+        "p99_ms": round(percentile(latencies, 0.99), 1)
+    }
+
+
+async def run_size(size, args):
+    apns_port, upstream_port, server_port = free_port(), free_port(), free_port()
+    mock_cmd = [sys.executable, MOCKS, "--apns-port", str(apns_port), "--upstream-port", str(upstream_port)]
+    for option in MOCK_OPTIONS:
+        mock_cmd += ["--" + option.replace("_", "-"), str(getattr(args, option))]
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    env = dict(
+        os.environ,
+        APNS_AUTH_KEY=base64.b64encode(pem).decode(),
+        APNS_SCHEME="http",
+        APNS_HOST="127.0.0.1",
+        APNS_PORT=str(apns_port),
+        VIAGGIATRENO_BASE=f"http://127.0.0.1:{upstream_port}/viaggiatreno/",
+        ITALO_BASE=f"http://127.0.0.1:{upstream_port}/italo/",
+        ACTIVITY_STORE="memory",
+        LOG_LEVEL="WARNING",
+        POLL_MIN_INTERVAL=str(args.poll_interval),
+        # The stand-ins need no protection; measure the server, not the rate limiter
+        UPSTREAM_RATE_LIMIT="0",
+        MAX_BATCH_SIZE=str(max(size, 5000))
+    )
+    server_cmd = [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(server_port), "--log-level", "warning"]
+
+    mocks = subprocess.Popen(mock_cmd, cwd=ROOT)
+    server = subprocess.Popen(server_cmd, cwd=ROOT, env=env)
+    base = f"http://127.0.0.1:{server_port}"
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    try:
+        async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+            await wait_ready(client, f"http://127.0.0.1:{upstream_port}/stats")
+            await wait_ready(client, f"{base}/health")
+            idle_rss, _ = rss_mb(server.pid)
+
+            now_ms = int(time.time() * 1000)
+            activities = [activity(i, now_ms) for i in range(size)]
+            rows = []
+            latencies, failures, elapsed = await drive(
+                client, f"{base}/register-token",
+                [{"train_id": a["train_id"], "push_token": a["push_token"]} for a in activities], args.concurrency
+            )
+            rows.append(request_row("register-token", latencies, failures, elapsed))
+            latencies, failures, elapsed = await drive(client, f"{base}/update-train-activity", activities, args.concurrency)
+            rows.append(request_row("update-train-activity", latencies, failures, elapsed))
+
+            # Let the first poll of every train land, then measure a steady-state window
+            await asyncio.sleep(args.poll_interval * 2)
+            before = parse_metrics((await client.get(f"{base}/metrics")).text)
+            totals_before = (await client.get(f"{base}/debug/cycle")).json()["totals"]
+            apns_before = (await client.get(f"http://127.0.0.1:{upstream_port}/stats")).json()["apns"]["requests"]
+            started = time.perf_counter()
+            await asyncio.sleep(args.periodic_seconds)
+            elapsed = time.perf_counter() - started
+            after = parse_metrics((await client.get(f"{base}/metrics")).text)
+            totals_after = (await client.get(f"{base}/debug/cycle")).json()["totals"]
+            mock_stats = (await client.get(f"http://127.0.0.1:{upstream_port}/stats")).json()
+            apns_after = mock_stats["apns"]["requests"]
+            rss, peak_rss = rss_mb(server.pid)
+
+            polls = histogram_delta(histogram(before, "trainss_train_poll_seconds"), histogram(after, "trainss_train_poll_seconds"))
+            apns = histogram_delta(histogram(before, "trainss_apns_request_seconds"), histogram(after, "trainss_apns_request_seconds"))
+            upstream = histogram_delta(
+                histogram(before, "trainss_upstream_request_seconds"), histogram(after, "trainss_upstream_request_seconds")
+            )
+
+            def ms(value):
+                return None if value is None else round(value * 1000, 1)
+
+            periodic = {
+                "pushes_per_second": round((apns_after - apns_before) / elapsed, 1),
+                "pushes_sent": counter(after, "trainss_cycle_pushes_total", result="sent") - counter(before, "trainss_cycle_pushes_total", result="sent"),
+                "pushes_skipped": counter(after, "trainss_cycle_pushes_total", result="skipped") - counter(before, "trainss_cycle_pushes_total", result="skipped"),
+                "trains_fetched": totals_after["trains_fetched"] - totals_before["trains_fetched"],
+                "tokens_served": totals_after["tokens_served"] - totals_before["tokens_served"],
+                "train_polls": int(polls[2]),
+                "poll_avg_ms": ms(polls[1] / polls[2]) if polls[2] else None,
+                "poll_p50_ms": ms(histogram_quantile(polls, 0.5)),
+                "poll_p99_ms": ms(histogram_quantile(polls, 0.99)),
+                "apns_p50_ms": ms(histogram_quantile(apns, 0.5)),
+                "apns_p99_ms": ms(histogram_quantile(apns, 0.99)),
+                "upstream_p50_ms": ms(histogram_quantile(upstream, 0.5)),
+                "upstream_p99_ms": ms(histogram_quantile(upstream, 0.99))
+            }
+            return {"size": size, "requests": rows, "periodic": periodic, "rss_mb": {"idle": idle_rss, "loaded": rss, "peak": peak_rss}, "mocks": mock_stats}
+    finally:
+        # Stop the server first so its last polls do not fail against gone mocks
+        for process in (server, mocks):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def report(result):
+    print(f"\n== {result['size']} activities ==")
+    print(f"{'stage':<24}{'requests':>10}{'failed':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for row in result["requests"]:
+        print(f"{row['stage']:<24}{row['requests']:>10}{row['failed']:>8}{row['per_second']:>10}{row['p50_ms']:>10}{row['p99_ms']:>10}")
+    print("periodic loop:")
+    for key, value in result["periodic"].items():
+        print(f"  {key:<20}{value}")
+    mocks = result["mocks"]
+    print(f"apns mock: {mocks['apns']}")
+    print(f"upstream mock: {mocks['upstream']}")
+    rss = result["rss_mb"]
+    print(f"rss: idle {rss['idle']:.1f} MB, loaded {rss['loaded']:.1f} MB, peak {rss['peak']:.1f} MB")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="100,1000,10000", help="comma separated activity counts")
+    parser.add_argument("--concurrency", type=int, default=64, help="requests in flight against the server")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="POLL_MIN_INTERVAL of the server under test")
+    parser.add_argument("--periodic-seconds", type=float, default=20.0, help="length of the periodic loop measurement")
+    parser.add_argument("--apns-latency", type=float, default=0.02)
+    parser.add_argument("--apns-jitter", type=float, default=0.01)
+    parser.add_argument("--apns-unregistered-rate", type=float, default=0.0)
+    parser.add_argument("--apns-throttle-rate", type=float, default=0.0)
+    parser.add_argument("--apns-error-rate", type=float, default=0.0)
+    parser.add_argument("--upstream-latency", type=float, default=0.05)
+    parser.add_argument("--upstream-error-rate", type=float, default=0.0)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    for size in (int(s) for s in args.sizes.split(",")):
+        report(asyncio.run(run_size(size, args)))
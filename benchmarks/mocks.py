@@ -0,0 +1,230 @@
+"""Local stand-ins for APNs, viaggiatreno and Italo.
+
+The APNs mock speaks HTTP/2 over plain TCP (h2c, prior knowledge) and answers
+every POST /3/device/<token> after a configurable latency, failing a
+configurable fraction of them with the errors APNs really returns
+(410 Unregistered, 429 TooManyRequests, 500 InternalServerError). The
+upstream mock replays the recorded fixtures: viaggiatreno under /viaggiatreno/
+and Italo under /italo/, with the delay changed on every request so each poll
+produces a meaningful update. GET /stats on the upstream port reports what
+both mocks have served, and GET /stats/trains how often each train was polled.
+
+Point the server at them with:
+
+    APNS_SCHEME=http APNS_HOST=127.0.0.1 APNS_PORT=<apns port>
+    VIAGGIATRENO_BASE=http://127.0.0.1:<upstream port>/viaggiatreno/
+    ITALO_BASE=http://127.0.0.1:<upstream port>/italo/
+
+Run from the repository root:
+
+    python benchmarks/mocks.py [--apns-port 8443] [--upstream-port 8081] [--apns-latency 0.02] ...
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+from datetime import datetime
+
+import h2.config
+import h2.connection
+import h2.events
+import h2.exceptions
+import h2.settings
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse, Response
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+class APNsMock:
+    """Minimal HTTP/2 APNs endpoint with injected latency and error rates."""
+
+    ERRORS = (
+        (410, "Unregistered"),
+        (429, "TooManyRequests"),
+        (500, "InternalServerError"),
+    )
+
+    def __init__(self, latency=0.0, jitter=0.0, unregistered_rate=0.0, throttle_rate=0.0, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rates = (unregistered_rate, throttle_rate, error_rate)
+        self.counts = {"requests": 0, "connections": 0}
+        self.bytes_received = 0
+
+    def _status(self):
+        roll = random.random()
+        for (status, reason), rate in zip(self.ERRORS, self.rates):
+            if roll < rate:
+                return status, reason
+            roll -= rate
+        return 200, None
+
+    async def _respond(self, conn, writer, stream_id):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        status, reason = self._status()
+        self.counts["requests"] += 1
+        self.counts[str(status)] = self.counts.get(str(status), 0) + 1
+        headers = [(":status", str(status)), ("apns-id", str(uuid.uuid4()).upper())]
+        body = b""
+        if reason is not None:
+            body = json.dumps({"reason": reason}).encode()
+            headers.append(("content-type", "application/json"))
+        headers.append(("content-length", str(len(body))))
+        try:
+            conn.send_headers(stream_id, headers, end_stream=not body)
+            if body:
+                conn.send_data(stream_id, body, end_stream=True)
+            writer.write(conn.data_to_send())
+            await writer.drain()
+        except Exception:
+            # The client went away or reset the stream while we were "processing"
+            pass
+
+    async def handle(self, reader, writer):
+        self.counts["connections"] += 1
+        conn = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False, header_encoding="utf-8"))
+        # APNs allows up to 1000 concurrent streams per connection
+        conn.local_settings = h2.settings.Settings(
+            client=False, initial_values={h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: 1000})
+        conn.initiate_connection()
+        writer.write(conn.data_to_send())
+        pending = set()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for event in conn.receive_data(data):
+                    if isinstance(event, h2.events.DataReceived):
+                        self.bytes_received += len(event.data)
+                        conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, h2.events.StreamEnded):
+                        task = asyncio.ensure_future(self._respond(conn, writer, event.stream_id))
+                        pending.add(task)
+                        task.add_done_callback(pending.discard)
+                    elif isinstance(event, h2.events.ConnectionTerminated):
+                        return
+                writer.write(conn.data_to_send())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        except h2.exceptions.ProtocolError:
+            self.counts["protocol_errors"] = self.counts.get("protocol_errors", 0) + 1
+        finally:
+            for task in pending:
+                task.cancel()
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def create_upstream_app(apns, latency=0.0, error_rate=0.0):
+    """viaggiatreno and Italo stand-ins replaying the fixtures in benchmarks/fixtures."""
+    with open(os.path.join(FIXTURES, "andamentoTreno_9544.json")) as f:
+        trenitalia = json.load(f)
+    with open(os.path.join(FIXTURES, "RicercaTrenoService_8901.json")) as f:
+        italo = json.load(f)
+
+    app = FastAPI()
+    counts = {"autocomplete": 0, "andamentoTreno": 0, "italo": 0, "errors": 0}
+    # Per train request counter, used to move the delay on every poll
+    polls = {}
+
+    async def simulate(kind):
+        counts[kind] += 1
+        if latency > 0:
+            await asyncio.sleep(latency)
+        if error_rate and random.random() < error_rate:
+            counts["errors"] += 1
+            return Response(status_code=503)
+        return None
+
+    def next_delay(key):
+        polls[key] = polls.get(key, 0) + 1
+        return polls[key] % 60
+
+    @app.get("/viaggiatreno/cercaNumeroTrenoTrenoAutocomplete/{train_number}")
+    async def autocomplete(train_number: str):
+        failure = await simulate("autocomplete")
+        if failure is not None:
+            return failure
+        midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        ts = int(midnight.timestamp() * 1000)
+        return PlainTextResponse(f"{train_number} - MILANO CENTRALE - {midnight:%d/%m/%y}|{train_number}-S01700-{ts}\n")
+
+    @app.get("/viaggiatreno/andamentoTreno/{station_code}/{train_number}/{timestamp}")
+    async def andamento_treno(station_code: str, train_number: str, timestamp: str):
+        failure = await simulate("andamentoTreno")
+        if failure is not None:
+            return failure
+        document = dict(trenitalia, numeroTreno=int(train_number) if train_number.isdigit() else train_number)
+        document["ritardo"] = next_delay(("Trenitalia", train_number))
+        document["oraUltimoRilevamento"] = int(time.time() * 1000)
+        return Response(json.dumps(document), media_type="application/json")
+
+    @app.get("/italo/RicercaTrenoService")
+    async def ricerca_treno(request: Request):
+        failure = await simulate("italo")
+        if failure is not None:
+            return failure
+        train_number = request.query_params.get("TrainNumber", "")
+        schedule = dict(italo["TrainSchedule"])
+        schedule["Distruption"] = dict(schedule.get("Distruption") or {}, DelayAmount=next_delay(("Italo", train_number)))
+        document = dict(italo, TrainSchedule=schedule, LastUpdate=time.strftime("%H:%M"))
+        return Response(json.dumps(document), media_type="application/json")
+
+    @app.get("/stats")
+    async def stats():
+        return {
+            "upstream": counts,
+            "apns": dict(apns.counts, bytes_received=apns.bytes_received),
+            "timestamp": time.time()
+        }
+
+    @app.get("/stats/trains")
+    async def train_stats():
+        return {f"{provider}/{train_number}": count for (provider, train_number), count in polls.items()}
+
+    return app
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--apns-port", type=int, default=8443)
+    parser.add_argument("--upstream-port", type=int, default=8081)
+    parser.add_argument("--apns-latency", type=float, default=0.02, help="seconds before every APNs response")
+    parser.add_argument("--apns-jitter", type=float, default=0.01, help="extra random APNs latency, in seconds")
+    parser.add_argument("--apns-unregistered-rate", type=float, default=0.0, help="fraction of pushes answered 410")
+    parser.add_argument("--apns-throttle-rate", type=float, default=0.0, help="fraction of pushes answered 429")
+    parser.add_argument("--apns-error-rate", type=float, default=0.0, help="fraction of pushes answered 500")
+    parser.add_argument("--upstream-latency", type=float, default=0.05, help="seconds before every upstream response")
+    parser.add_argument("--upstream-error-rate", type=float, default=0.0, help="fraction of upstream requests answered 503")
+    return parser.parse_args(argv)
+
+
+async def main(args):
+    apns = APNsMock(
+        latency=args.apns_latency,
+        jitter=args.apns_jitter,
+        unregistered_rate=args.apns_unregistered_rate,
+        throttle_rate=args.apns_throttle_rate,
+        error_rate=args.apns_error_rate
+    )
+    app = create_upstream_app(apns, latency=args.upstream_latency, error_rate=args.upstream_error_rate)
+    upstream = uvicorn.Server(uvicorn.Config(app, host=args.host, port=args.upstream_port, log_level="warning"))
+    await asyncio.gather(apns.serve(args.host, args.apns_port), upstream.serve())
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -1,170 +1,596 @@
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 import jwt
+from cryptography.hazmat.primitives import serialization
 import time
 import json
 import httpx
-from typing import Optional, Dict
+from typing import Optional, Dict, List
 import asyncio
 import os
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
+from pythonjsonlogger import jsonlogger
 import base64
-import requests
-from datetime import datetime, timedelta, timezone
+import hashlib
+import hmac
+import heapq
+import random
+import sqlite3
+import sys
+import weakref
+import socket
+import bisect
+from collections import OrderedDict, deque
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from zoneinfo import ZoneInfo
 import urllib.parse as urlp
-try:
-    from urllib.request import urlopen
-except ImportError:
-    from urllib import urlopen  
 
 
-def add_minutes(time_str_or_millis, minutes_to_add: int) -> str:
+# eta functions
+ROME = ZoneInfo("Europe/Rome")
+MINUTE_MS = 60_000
+
+@lru_cache(maxsize=4096)
+def _rome_wall_clock_ms(day_ordinal, minute_of_day):
+    day = date.fromordinal(day_ordinal)
+    local = datetime(day.year, day.month, day.day, minute_of_day // 60, minute_of_day % 60, tzinfo=ROME)
+    return int(local.timestamp()) * 1000
+
+def rome_clock_ms(hhmm, now_ms):
+    """Epoch milliseconds of an Italian wall-clock "HH:MM", taken on the day (yesterday,
+    today or tomorrow) that puts it closest to now_ms; None when it does not parse."""
     try:
-        # If the input is an int or a string number, treat it as milliseconds
-        if isinstance(time_str_or_millis, int) or (isinstance(time_str_or_millis, str) and time_str_or_millis.isdigit()):
-            millis = int(time_str_or_millis)
-            date_obj = datetime.fromtimestamp(millis / 1000, tz=timezone.utc)  # Convert from UTC
-        else:
-            # Else, assume it's a "HH:MM" string
-            date_obj = datetime.strptime(time_str_or_millis, "%H:%M")
-        
-        # Adjust for local timezone (use datetime.timezone)
-        date_obj = date_obj.replace(tzinfo=timezone(timedelta(hours=1)))
-        
-        # Add the minutes
-        new_time = date_obj + timedelta(minutes=minutes_to_add)
-        
-        # Convert back to local timezone if necessary
-        new_time = new_time.astimezone(timezone(timedelta(hours=1)))
-        
-        # Return formatted time
-        return new_time.strftime("%H:%M")
-    except (ValueError, TypeError):
+        hours, minutes = hhmm.split(":")
+        minute_of_day = int(hours) * 60 + int(minutes)
+    except (AttributeError, ValueError):
         return None
+    if not 0 <= minute_of_day < 24 * 60:
+        return None
+    today = datetime.fromtimestamp(now_ms / 1000, ROME).date().toordinal()
+    return min(
+        (_rome_wall_clock_ms(day, minute_of_day) for day in (today - 1, today, today + 1)),
+        key=lambda candidate: abs(candidate - now_ms)
+    )
 
-def how_much_trenitalia(to_time_str: str) -> int:
-    try:
-        # Get current time in minutes since midnight
-        now = datetime.now(timezone(timedelta(hours=0)))
-        current_minutes = now.hour * 60 + now.minute
+def minutes_until(eta_ms, now_ms):
+    """Whole minutes on the clock from now_ms to eta_ms, never negative; None without an ETA."""
+    if eta_ms is None:
+        return None
+    return max(0, eta_ms // MINUTE_MS - now_ms // MINUTE_MS)
 
-        # Parse the target time
-        target_hour, target_minute = map(int, to_time_str.split(":"))
-        target_minutes = target_hour * 60 + target_minute
+def now_millis():
+    return int(time.time() * 1000)
 
-        # Calculate difference
-        difference = target_minutes - current_minutes
-        if difference < 0:
-            difference += 24 * 60  # handle next day case
 
-        return difference
-    except (ValueError, IndexError):
-        return None
-    
-def how_much_italo(to_time_str: str) -> int:
-    try:
-        # Get current time in minutes since midnight
-        now = datetime.now(timezone(timedelta(hours=1)))
-        current_minutes = now.hour * 60 + now.minute
+# metrics
+class Counter:
+    """Monotonic counter, optionally split by label values."""
 
-        # Parse the target time
-        target_hour, target_minute = map(int, to_time_str.split(":"))
-        target_minutes = target_hour * 60 + target_minute
+    type = "counter"
 
-        # Calculate difference
-        difference = target_minutes - current_minutes
-        if difference < 0:
-            difference += 24 * 60  # handle next day case
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
 
-        return difference
-    except (ValueError, IndexError):
-        return None
-    
-def time_to_millis(time_str: str) -> int:
-    try:
-        # Get the current date
-        today = datetime.now().date()
+    def inc(self, *labelvalues, amount=1):
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
 
-        # Parse the time string into a datetime object with today's date
-        time_obj = datetime.strptime(time_str, "%H:%M")
-        time_obj = time_obj.replace(year=today.year, month=today.month, day=today.day)
+    def samples(self):
+        for labelvalues, value in self._values.items():
+            yield self.name, dict(zip(self.labelnames, labelvalues)), value
 
-        # Adjust for local timezone (use datetime.timezone)
-        time_obj = time_obj.replace(tzinfo=timezone(timedelta(hours=1)))
-        
-        # Convert to UTC time zone
-        time_obj = time_obj.astimezone(timezone.utc)
-        
-        # Get the Unix epoch (1970-01-01 00:00:00 UTC)
-        epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus exposition format."""
 
-        # Calculate the difference in seconds and convert to milliseconds
-        delta = time_obj - epoch
-        return int(delta.total_seconds() * 1000)
-    except ValueError:
-        return None
+    type = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
 
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}
 
-# trenitalia functions
-def fetch_train_info(train_number):
-    url = f"http://www.viaggiatreno.it/infomobilita/resteasy/viaggiatreno/cercaNumeroTrenoTrenoAutocomplete/{train_number}"
-    timestamp = int(datetime.now().timestamp() * 1000)
-    response = requests.get(url)
-    data = response.text.strip().split("|")
-    station_code = data[1].split("-")[1]
-
-    url = f"http://www.viaggiatreno.it/infomobilita/resteasy/viaggiatreno/andamentoTreno/{station_code}/{train_number}/{timestamp}"
-    response = requests.get(url)
-    train_data = response.json()
-    return train_data
-
-def fetch_parameter(parameter, train_number):
-    train_data = fetch_train_info(train_number)
-    for v in train_data:
-        if v == parameter:
-            return train_data[v]
-
-def fetch_fermate_info(parameter, train_number):
-    fermate_database = fetch_parameter("fermate", train_number)
-
-    if parameter == "prossima_stazione":
-        for d in fermate_database:
-            stazione = d.get("stazione")
-            partenza_reale = d.get("partenzaReale")
-            if partenza_reale is None:
-                return stazione
-    elif parameter == "prossimo_binario":
-        for d in fermate_database:
-            binarioEffettivoArrivo = d.get("binarioEffettivoArrivoDescrizione")
-            binarioProgrammatoArrivo = d.get("binarioProgrammatoArrivoDescrizione")
-            binarioEffettivoPartenza = d.get("binarioEffettivoPartenzaDescrizione")
-            binarioProgrammatoPartenza = d.get("binarioProgrammatoPartenzaDescrizione")
-            partenza_reale = d.get("partenzaReale")
-            if partenza_reale is None:
-                if binarioEffettivoPartenza is not None:
-                    return binarioEffettivoPartenza
-                elif binarioProgrammatoPartenza is not None:
-                    return binarioProgrammatoPartenza
-                elif binarioEffettivoArrivo is not None:
-                    return binarioEffettivoArrivo
-                elif binarioProgrammatoArrivo is not None:
-                    return binarioProgrammatoArrivo
+    def observe(self, value, *labelvalues):
+        series = self._series.get(labelvalues)
+        if series is None:
+            series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self):
+        for labelvalues, (counts, total, count) in self._series.items():
+            labels = dict(zip(self.labelnames, labelvalues))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                yield self.name + "_bucket", dict(labels, le="+Inf" if bound == float("inf") else repr(bound)), cumulative
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, count
+
+class Gauge:
+    """Value read when metrics are scraped; `read` returns a number or a list of (labels, value)."""
+
+    type = "gauge"
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def samples(self):
+        value = self.read()
+        if isinstance(value, list):
+            for labels, v in value:
+                yield self.name, labels, v
+        else:
+            yield self.name, {}, value
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                    lines.append(f"{name}{{{label_text}}} {value}")
                 else:
-                    return "-"
-                
-    elif parameter == "tempo_prossima_stazione":
-        ritardo = fetch_parameter("ritardo", train_number)
-        for d in fermate_database:
-            partenza_teorica = d.get("partenza_teorica")
-            arrivo_teorico = d.get("arrivo_teorico")
-            partenza_reale = d.get("partenzaReale")
-            if partenza_reale is None:
-                if arrivo_teorico is not None:
-                    return how_much_trenitalia(add_minutes(arrivo_teorico, ritardo))
-                elif partenza_teorica is not None:
-                    return how_much_trenitalia(add_minutes(partenza_teorica, ritardo))
+                    lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+UPSTREAM_SECONDS = metrics.register(Histogram(
+    "trainss_upstream_request_seconds", "Upstream train data requests (cache misses) by provider and outcome", ("provider", "outcome")))
+JWT_SIGN_SECONDS = metrics.register(Histogram(
+    "trainss_jwt_sign_seconds", "Time spent signing APNs provider tokens", buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05)))
+JWT_REQUESTS = metrics.register(Counter(
+    "trainss_jwt_requests_total", "APNs provider token requests by result", ("result",)))
+APNS_SECONDS = metrics.register(Histogram(
+    "trainss_apns_request_seconds", "APNs request latency", ("priority",)))
+APNS_RESPONSES = metrics.register(Counter(
+    "trainss_apns_responses_total", "APNs responses by status code and outcome", ("code", "outcome")))
+TRAIN_POLL_SECONDS = metrics.register(Histogram(
+    "trainss_train_poll_seconds", "Duration of one train's periodic poll: its upstream fetch and pushes"))
+CYCLE_PUSHES = metrics.register(Counter(
+    "trainss_cycle_pushes_total", "Periodic update decisions per token", ("result",)))
+CYCLE_TRAINS = metrics.register(Counter(
+    "trainss_cycle_trains_total", "Trains polled by periodic updates by result", ("result",)))
+UPSTREAM_REJECTED = metrics.register(Counter(
+    "trainss_upstream_rejected_total", "Upstream requests refused locally by provider and reason", ("provider", "reason")))
+WATCHDOG_RESTARTS = metrics.register(Counter(
+    "trainss_watchdog_restarts_total", "Background loops restarted by the watchdog", ("loop",)))
+
+# upstream http client
+UPSTREAM_TIMEOUT = float(os.environ.get("UPSTREAM_TIMEOUT", "10"))
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", "50"))
+UPSTREAM_MAX_CONNECTIONS_PER_HOST = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS_PER_HOST", "10"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.environ.get("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+# Upstream base urls, overridable to point at local stand-ins (see benchmarks/loadtest.py)
+VIAGGIATRENO_BASE = os.environ.get("VIAGGIATRENO_BASE", "http://www.viaggiatreno.it/infomobilita/resteasy/viaggiatreno/")
+ITALO_BASE = os.environ.get("ITALO_BASE", "https://italoinviaggio.italotreno.it/api/")
+
+_upstream_client = None
+_upstream_host_slots = {}
+# Per upstream host: when it last answered and when it last failed, for /ready
+upstream_reachability = {}
+
+def get_upstream_client():
+    """Return the shared pooled client used for viaggiatreno and Italo requests."""
+    global _upstream_client
+    if _upstream_client is None or _upstream_client.is_closed:
+        _upstream_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(UPSTREAM_TIMEOUT, connect=5.0),
+            limits=httpx.Limits(
+                max_connections=UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=UPSTREAM_MAX_CONNECTIONS,
+                keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY
+            ),
+            headers={"user-agent": "trainss-server"}
+        )
+    return _upstream_client
+
+async def close_upstream_client():
+    global _upstream_client
+    if _upstream_client is not None:
+        await _upstream_client.aclose()
+        _upstream_client = None
+
+async def upstream_get(url):
+    """GET an upstream url through the shared client, capping in-flight requests per host."""
+    host = urlp.urlsplit(url).netloc
+    slots = _upstream_host_slots.get(host)
+    if slots is None:
+        slots = _upstream_host_slots[host] = asyncio.Semaphore(UPSTREAM_MAX_CONNECTIONS_PER_HOST)
+    reachability = upstream_reachability.setdefault(host, {"last_ok": None, "last_error": None, "error": None})
+    async with slots:
+        try:
+            response = await get_upstream_client().get(url)
+        except httpx.HTTPError as e:
+            reachability["last_error"] = time.time()
+            reachability["error"] = f"{type(e).__name__}: {e}"
+            raise
+    if response.status_code >= 500:
+        reachability["last_error"] = time.time()
+        reachability["error"] = f"HTTP {response.status_code}"
+    else:
+        reachability["last_ok"] = time.time()
+    response.raise_for_status()
+    return response
+
+class UpstreamCache:
+    """In-process TTL cache for upstream train documents.
+
+    Entries are kept in LRU order and evicted beyond `max_entries` or
+    `max_bytes` (measured on the raw response size). Concurrent misses for the
+    same key share one in-flight fetch, and when a refresh fails an entry up to
+    `stale_grace` seconds past its TTL is served instead of the error.
+    """
+
+    def __init__(self, ttl=5.0, stale_grace=120.0, max_entries=2000, max_bytes=64 * 1024 * 1024):
+        self.ttl = ttl
+        self.stale_grace = stale_grace
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.bytes = 0
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "stale_served": 0, "evictions": 0}
+
+    def _store(self, key, value, size):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[2]
+        self._entries[key] = (value, time.monotonic(), size)
+        self.bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.counters["evictions"] += 1
+
+    async def get_or_fetch(self, key, fetch):
+        """Return the cached value for key, or await `fetch()` which returns (value, size_in_bytes)."""
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[1] < self.ttl:
+            self._entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return entry[0]
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.counters["coalesced"] += 1
+            return await asyncio.shield(inflight)
+
+        self.counters["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value, size = await fetch()
+        except asyncio.CancelledError:
+            # Only this caller was cancelled: the waiters sharing its fetch get the stale
+            # entry or an ordinary failure, not a CancelledError of their own
+            if entry is not None and time.monotonic() - entry[1] < self.ttl + self.stale_grace:
+                future.set_result(entry[0])
+            else:
+                future.set_exception(UpstreamUnavailable(f"Shared fetch of {key} was cancelled"))
+                future.exception()
+            raise
+        except Exception as e:
+            if entry is not None and time.monotonic() - entry[1] < self.ttl + self.stale_grace:
+                self.counters["stale_served"] += 1
+                if isinstance(e, UpstreamUnavailable):
+                    # Refused locally (circuit open, rate limited): the guard already logged why
+                    logger.debug("Serving last known good data for %s: %s", key, e)
                 else:
-                    return 0
+                    logger.warning(f"Serving stale upstream data for {key}: {str(e)}")
+                future.set_result(entry[0])
+                return entry[0]
+            future.set_exception(e)
+            future.exception()  # Mark retrieved when nobody else was waiting
+            raise
+        else:
+            self._store(key, value, size)
+            future.set_result(value)
+            return value
+        finally:
+            del self._inflight[key]
+
+    def invalidate(self, key):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[2]
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return dict(self.counters, entries=len(self._entries), bytes=self.bytes, inflight=len(self._inflight))
+
+upstream_cache = UpstreamCache(
+    ttl=float(os.environ.get("UPSTREAM_CACHE_TTL", "5")),
+    stale_grace=float(os.environ.get("UPSTREAM_CACHE_STALE_GRACE", "120")),
+    max_entries=int(os.environ.get("UPSTREAM_CACHE_MAX_ENTRIES", "2000")),
+    max_bytes=int(os.environ.get("UPSTREAM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+)
+
+# upstream rate limiting and circuit breaking
+UPSTREAM_RATE_LIMIT = float(os.environ.get("UPSTREAM_RATE_LIMIT", "25"))
+UPSTREAM_RATE_BURST = float(os.environ.get("UPSTREAM_RATE_BURST", "50"))
+UPSTREAM_RATE_MAX_WAIT = float(os.environ.get("UPSTREAM_RATE_MAX_WAIT", "2"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get("CIRCUIT_RESET_TIMEOUT", "30"))
+CIRCUIT_RESET_TIMEOUT_MAX = float(os.environ.get("CIRCUIT_RESET_TIMEOUT_MAX", "300"))
+
+class UpstreamUnavailable(Exception):
+    """Raised without contacting a provider whose circuit is open or whose rate limit is used up,
+    and to the callers sharing a fetch whose owner was cancelled."""
+
+class TokenBucket:
+    """Token bucket refilled at `rate` tokens per second up to `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self, now):
+        """Take a token, possibly ahead of time; returns how long to wait before using it."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self):
+        self.tokens += 1
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures and rejects calls for
+    `reset_timeout` seconds, then lets a single probe through (half-open): its
+    success closes the circuit, its failure reopens it for twice as long, up to
+    `max_reset_timeout`."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, max_reset_timeout=300.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.timeout = reset_timeout
+        self.opens = 0
+        self._probing = False
+
+    def available(self, now):
+        """Whether a call would be let through right now (without claiming the probe)."""
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            return now - self.opened_at >= self.timeout
+        return not self._probing
+
+    def allow(self, now):
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if now - self.opened_at < self.timeout:
+                return False
+            self.state = "half_open"
+            self._probing = False
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def release_probe(self):
+        """Give the probe back when it ended without telling anything about the upstream."""
+        self._probing = False
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info("Circuit closed after a successful probe")
+        self.state = "closed"
+        self.failures = 0
+        self.timeout = self.reset_timeout
+        self._probing = False
+
+    def record_failure(self, now):
+        self.failures += 1
+        if self.state == "half_open":
+            self._open(now, min(self.timeout * 2, self.max_reset_timeout))
+        elif self.state == "closed" and self.failures >= self.failure_threshold:
+            self._open(now, self.reset_timeout)
+
+    def _open(self, now, timeout):
+        self.state = "open"
+        self.opened_at = now
+        self.timeout = timeout
+        self.opens += 1
+        self._probing = False
+
+    def state_dict(self, now):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "retry_in_seconds": round(max(0.0, self.opened_at + self.timeout - now), 1) if self.state == "open" else 0.0,
+            "opens": self.opens
+        }
+
+def is_upstream_failure(error):
+    """Errors that say the provider is down or overloaded (not e.g. an unknown train)."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(error, (httpx.TransportError, OSError, asyncio.TimeoutError))
+
+class UpstreamGuard:
+    """Rate limiter and circuit breaker in front of one provider's requests.
+
+    Calls beyond the rate wait for a token, or fail fast with UpstreamUnavailable
+    when the wait would exceed `max_wait`; calls while the circuit is open fail
+    fast too, leaving the upstream cache to serve its last known good document.
+    """
+
+    def __init__(self, provider, rate, burst, max_wait, breaker):
+        self.provider = provider
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self.max_wait = max_wait
+        self.breaker = breaker
+        self.rejected = {"circuit_open": 0, "rate_limited": 0}
+
+    def available(self, now):
+        return self.breaker.available(now)
+
+    async def call(self, fetch):
+        now = time.monotonic()
+        if self.bucket is not None:
+            wait = self.bucket.reserve(now)
+            if wait > self.max_wait:
+                self.bucket.refund()
+                self.rejected["rate_limited"] += 1
+                UPSTREAM_REJECTED.inc(self.provider, "rate_limited")
+                raise UpstreamUnavailable(f"{self.provider} rate limit of {self.bucket.rate:g}/s exceeded")
+        else:
+            wait = 0.0
+        if not self.breaker.allow(now):
+            if self.bucket is not None:
+                self.bucket.refund()
+            self.rejected["circuit_open"] += 1
+            UPSTREAM_REJECTED.inc(self.provider, "circuit_open")
+            raise UpstreamUnavailable(f"{self.provider} circuit is open")
+        try:
+            if wait > 0:
+                await asyncio.sleep(wait)
+            result = await fetch()
+        except asyncio.CancelledError:
+            self.breaker.release_probe()
+            raise
+        except Exception as e:
+            if is_upstream_failure(e):
+                was_open = self.breaker.state == "open"
+                self.breaker.record_failure(time.monotonic())
+                if self.breaker.state == "open" and not was_open:
+                    logger.error(f"Circuit for {self.provider} opened for {self.breaker.timeout:g}s: {str(e)}")
+            else:
+                self.breaker.record_success()
+            raise
+        self.breaker.record_success()
+        return result
+
+    def state(self, now):
+        return dict(self.breaker.state_dict(now), rejected=self.rejected)
+
+upstream_guards = {
+    provider: UpstreamGuard(
+        provider, UPSTREAM_RATE_LIMIT, UPSTREAM_RATE_BURST, UPSTREAM_RATE_MAX_WAIT,
+        CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT, CIRCUIT_RESET_TIMEOUT_MAX)
+    )
+    for provider in ("Trenitalia", "Italo")
+}
+
+def upstream_guard(provider):
+    # fetch_train_snapshot treats every provider but Trenitalia as Italo
+    return upstream_guards["Trenitalia" if provider == "Trenitalia" else "Italo"]
+
+# trenitalia functions
+SERVICE_DAY_ROLLOVER_HOUR = int(os.environ.get("SERVICE_DAY_ROLLOVER_HOUR", "3"))
+
+def service_day():
+    """Current railway service day; trains running past midnight belong to the previous one."""
+    now = datetime.now(ROME)
+    return (now - timedelta(hours=SERVICE_DAY_ROLLOVER_HOUR)).date()
+
+class StationCodeIndex:
+    """Train number -> (origin station code, departure-date timestamp) for the service day.
+
+    Resolved once through cercaNumeroTrenoTrenoAutocomplete and reused by every
+    later poll, so steady-state polling only calls andamentoTreno. The whole
+    index is dropped when the service day rolls over.
+    """
+
+    def __init__(self):
+        self.day = service_day()
+        self._cache = UpstreamCache(ttl=36 * 3600, stale_grace=0, max_entries=50000)
+
+    def _check_rollover(self):
+        today = service_day()
+        if today != self.day:
+            logger.info(f"Service day rolled over to {today}, dropping {self._cache.stats()['entries']} station codes")
+            self._cache.clear()
+            self.day = today
+
+    async def lookup(self, train_number):
+        self._check_rollover()
+
+        async def fetch():
+            url = f"{VIAGGIATRENO_BASE}cercaNumeroTrenoTrenoAutocomplete/{train_number}"
+            response = await upstream_get(url)
+            data = response.text.strip().split("|")
+            parts = data[1].split("\n")[0].strip().split("-")
+            station_code = parts[1]
+            if len(parts) > 2 and parts[2].isdigit():
+                departure_ts = int(parts[2])
+            else:
+                departure_ts = int(datetime.now().timestamp() * 1000)
+            return (station_code, departure_ts), len(station_code)
+
+        return await self._cache.get_or_fetch(str(train_number), fetch)
+
+    def invalidate(self, train_number):
+        self._cache.invalidate(str(train_number))
+
+    async def prewarm(self, train_numbers):
+        """Resolve the station codes of the given trains ahead of their first poll."""
+        results = await asyncio.gather(*(self.lookup(n) for n in set(train_numbers)), return_exceptions=True)
+        failed = sum(1 for r in results if isinstance(r, Exception))
+        logger.info(f"Pre-warmed station codes for {len(results) - failed} trains ({failed} failed)")
+
+    def stats(self):
+        return dict(self._cache.stats(), day=str(self.day))
+
+station_index = StationCodeIndex()
+
+async def fetch_train_info(train_number):
+    async def fetch():
+        return await upstream_guards["Trenitalia"].call(lambda: fetch_train_info_upstream(train_number))
+    return await upstream_cache.get_or_fetch(("Trenitalia", str(train_number)), fetch)
+
+async def fetch_train_info_upstream(train_number):
+    """Fetch the andamentoTreno document of a train, returning it with its size in bytes."""
+    station_code, timestamp = await station_index.lookup(train_number)
+
+    url = f"{VIAGGIATRENO_BASE}andamentoTreno/{station_code}/{train_number}/{timestamp}"
+    started = time.perf_counter()
+    try:
+        response = await upstream_get(url)
+        train_data = response.json()
+    except Exception as e:
+        UPSTREAM_SECONDS.observe(time.perf_counter() - started, "trenitalia", "error")
+        # A 404 or an empty/garbled document means the cached origin is wrong (e.g. a cancelled
+        # run): resolve it again next time. Timeouts and 5xx say nothing about the origin.
+        if isinstance(e, ValueError) or (isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 404):
+            station_index.invalidate(train_number)
+        raise
+    UPSTREAM_SECONDS.observe(time.perf_counter() - started, "trenitalia", "ok")
+    return train_data, len(response.content)
 
 # italo functions
 def _decode_json (s):
@@ -185,10 +611,15 @@ def _decode_lines (s, linefunc):
        
 class ItaloAPI:
     def __init__ (self, **options):
-        self.base = 'https://italoinviaggio.italotreno.it/api/'
+        self.base = options.get('base', ITALO_BASE)
         self.__verbose = options.get('verbose', False)
-        self.__urlopen = options.get('urlopen', urlopen)
+        # Optional blocking urlopen replacement (test seam); it runs in a worker thread
+        self.__urlopen = options.get('urlopen')
         self.__plainoutput = options.get('plainoutput', False)
+        # Shared response cache; pass cache=None to always hit the upstream
+        self.__cache = options.get('cache', upstream_cache)
+        # Rate limiter and circuit breaker; pass guard=None to call the upstream unguarded
+        self.__guard = options.get('guard', upstream_guards["Italo"])
         self.__decoders = {
             'RicercaTrenoService':     _decode_json,
             'RicercaStazioneService':      _decode_json,
@@ -207,7 +638,7 @@ class ItaloAPI:
         query='&TrainNumber='+str(train_number)
         return query
         
-    def call (self, train_number, **options):
+    async def call (self, train_number, **options):
         plain = options.get('plainoutput', self.__plainoutput)
         verbose = options.get('verbose', self.__verbose)
         
@@ -218,96 +649,943 @@ class ItaloAPI:
         if verbose:
             print (url)
 
-        req = self.__urlopen(url)
-        data = req.read().decode('utf-8')
+        async def fetch():
+            if self.__guard is not None:
+                return await self.__guard.call(fetch_upstream)
+            return await fetch_upstream()
+
+        async def fetch_upstream():
+            started = time.perf_counter()
+            try:
+                if self.__urlopen is not None:
+                    req = await asyncio.to_thread(self.__urlopen, url)
+                    data = req.read().decode('utf-8')
+                else:
+                    response = await upstream_get(url)
+                    data = response.text
+            except Exception:
+                UPSTREAM_SECONDS.observe(time.perf_counter() - started, "italo", "error")
+                raise
+            UPSTREAM_SECONDS.observe(time.perf_counter() - started, "italo", "ok")
+            
+            if plain:
+                return data, len(data)
+            else:
+                return self.__checkAndDecode ('RicercaTrenoService', data), len(data)
+
+        if self.__cache is None:
+            value, _ = await fetch()
+            return value
+        return await self.__cache.get_or_fetch(("Italo", str(train_number), plain), fetch)
         
-        if plain:
-            return data
+# train snapshot functions
+class TrainSnapshot:
+    """Content-state fields refreshed by periodic_updates, parsed once per upstream document.
+
+    `eta_ms` is the expected time at the next stop (delay included) in epoch
+    milliseconds; `countdown` derives tempoProssimaStazione from it for any "now".
+    """
+
+    FIELDS = (
+        "ritardo",
+        "prossimaStazione",
+        "prossimoBinario",
+        "tempoProssimaStazione",
+        "stazioneUltimoRilevamento",
+        "orarioUltimoRilevamento",
+    )
+    __slots__ = FIELDS + ("eta_ms",)
+
+    def __init__(self, ritardo=None, prossimaStazione=None, prossimoBinario=None, tempoProssimaStazione=None,
+                 stazioneUltimoRilevamento=None, orarioUltimoRilevamento=None, eta_ms=None):
+        self.ritardo = ritardo
+        self.prossimaStazione = prossimaStazione
+        self.prossimoBinario = prossimoBinario
+        self.tempoProssimaStazione = tempoProssimaStazione
+        self.stazioneUltimoRilevamento = stazioneUltimoRilevamento
+        self.orarioUltimoRilevamento = orarioUltimoRilevamento
+        self.eta_ms = eta_ms
+
+    def as_tuple(self):
+        return tuple(getattr(self, name) for name in self.FIELDS)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    def countdown(self, now_ms):
+        """This snapshot with tempoProssimaStazione counted down to now_ms."""
+        if self.eta_ms is None:
+            return self
+        snapshot = TrainSnapshot(*self.as_tuple(), eta_ms=self.eta_ms)
+        snapshot.tempoProssimaStazione = minutes_until(self.eta_ms, now_ms)
+        return snapshot
+
+    def __eq__(self, other):
+        return isinstance(other, TrainSnapshot) and self.as_tuple() == other.as_tuple()
+
+    def __repr__(self):
+        return f"TrainSnapshot({self.as_dict()})"
+
+def parse_trenitalia(train_data, now_ms=None):
+    """Parse an andamentoTreno document in one pass over its stops."""
+    if now_ms is None:
+        now_ms = now_millis()
+    ritardo = train_data.get("ritardo")
+    snapshot = TrainSnapshot(
+        ritardo=ritardo,
+        stazioneUltimoRilevamento=train_data.get("stazioneUltimoRilevamento"),
+        orarioUltimoRilevamento=train_data.get("oraUltimoRilevamento")
+    )
+
+    # The next stop is the first one the train has not departed from yet
+    for d in train_data.get("fermate") or ():
+        if d.get("partenzaReale") is not None:
+            continue
+        snapshot.prossimaStazione = d.get("stazione")
+
+        binario = d.get("binarioEffettivoPartenzaDescrizione")
+        if binario is None:
+            binario = d.get("binarioProgrammatoPartenzaDescrizione")
+        if binario is None:
+            binario = d.get("binarioEffettivoArrivoDescrizione")
+        if binario is None:
+            binario = d.get("binarioProgrammatoArrivoDescrizione")
+        snapshot.prossimoBinario = binario if binario is not None else "-"
+
+        # Scheduled times are epoch milliseconds already
+        scheduled = d.get("arrivo_teorico")
+        if scheduled is None:
+            scheduled = d.get("partenza_teorica")
+        try:
+            snapshot.eta_ms = int(scheduled) + int(ritardo or 0) * MINUTE_MS
+        except (TypeError, ValueError):
+            snapshot.tempoProssimaStazione = 0
         else:
-            return self.__checkAndDecode ('RicercaTrenoService', data)
-        
-def fetch_parameter_italo(parameter, train_number):
-    data = ItaloAPI().call(train_number)
-
-    if parameter == "stazioneUltimoRilevamento":
-        return ""
-    if parameter == "orarioUltimoRilevamento":
-        for dict in data:
-            if dict == "LastUpdate":
-                return time_to_millis(data[dict])
-    elif parameter == "ritardo":
-        for dict in data:
-            if dict == "TrainSchedule":
-                for key in data[dict]:
-                    if key == "Distruption":
-                        for keyy in data[dict][key]:
-                            if keyy == "DelayAmount":
-                                return data[dict][key][keyy]
-    elif parameter == "prossimaStazione":
-        for dict in data:
-            if dict == "TrainSchedule":
-                for key in data[dict]:
-                    if key == "StazioniNonFerme":
-                        for dictt in data[dict][key]:
-                            for keyy in dictt:
-                                if keyy == "LocationDescription":
-                                    return dictt[keyy]
-    elif parameter == "prossimoBinario":
-        for dict in data:
-            if dict == "TrainSchedule":
-                for key in data[dict]:
-                    if key == "StazioniNonFerme":
-                        for dictt in data[dict][key]:
-                            for keyy in dictt:
-                                if keyy == "ActualArrivalPlatform":
-                                    if dictt[keyy] is not None:
-                                        return dictt[keyy]
-                                    else:
-                                        return "-"
-    elif parameter == "tempoProssimaStazione":
-        delay = 0
-        for dict in data:
-            if dict == "TrainSchedule":
-                for key in data[dict]:
-                    if key == "Distruption":
-                        for keyy in data[dict][key]:
-                            if keyy == "DelayAmount":
-                                delay = data[dict][key][keyy]
-        for dict in data:
-            if dict == "TrainSchedule":
-                for key in data[dict]:
-                    if key == "StazioniNonFerme":
-                        for dictt in data[dict][key]:
-                            for keyy in dictt:
-                                if keyy == "EstimatedArrivalTime" and dictt[keyy] != "01:00":
-                                    return how_much_italo(add_minutes(dictt[keyy], delay))
-                            for keyy in dictt:
-                                if keyy == "EstimatedDepartureTime" and dictt[keyy] != "01:00":
-                                    return how_much_italo(add_minutes(dictt[keyy], delay))
+            snapshot.tempoProssimaStazione = minutes_until(snapshot.eta_ms, now_ms)
+        break
+
+    return snapshot
+
+def parse_italo(data, now_ms=None):
+    """Parse a RicercaTrenoService document in one pass over its upcoming stations.
+    Italo reports Italian wall-clock "HH:MM" times; they are resolved to epoch
+    milliseconds against now_ms."""
+    if now_ms is None:
+        now_ms = now_millis()
+    snapshot = TrainSnapshot(stazioneUltimoRilevamento="")
+    if "LastUpdate" in data:
+        snapshot.orarioUltimoRilevamento = rome_clock_ms(data["LastUpdate"], now_ms)
+
+    schedule = data.get("TrainSchedule") or {}
+    distruption = schedule.get("Distruption") or {}
+    delay = 0
+    if "DelayAmount" in distruption:
+        snapshot.ritardo = delay = distruption["DelayAmount"]
 
+    found_station = found_platform = found_time = False
+    for stop in schedule.get("StazioniNonFerme") or ():
+        if not found_station and "LocationDescription" in stop:
+            snapshot.prossimaStazione = stop["LocationDescription"]
+            found_station = True
+        if not found_platform and "ActualArrivalPlatform" in stop:
+            platform = stop["ActualArrivalPlatform"]
+            snapshot.prossimoBinario = platform if platform is not None else "-"
+            found_platform = True
+        if not found_time:
+            # "01:00" is how Italo reports a missing time
+            if "EstimatedArrivalTime" in stop and stop["EstimatedArrivalTime"] != "01:00":
+                estimated = rome_clock_ms(stop["EstimatedArrivalTime"], now_ms)
+                found_time = True
+            elif "EstimatedDepartureTime" in stop and stop["EstimatedDepartureTime"] != "01:00":
+                estimated = rome_clock_ms(stop["EstimatedDepartureTime"], now_ms)
+                found_time = True
+            if found_time and estimated is not None:
+                snapshot.eta_ms = estimated + int(delay or 0) * MINUTE_MS
+                snapshot.tempoProssimaStazione = minutes_until(snapshot.eta_ms, now_ms)
+        if found_station and found_platform and found_time:
+            break
 
+    return snapshot
+
+# Parsed snapshot per train with the document it was parsed from, so a document
+# served again from the upstream cache is not parsed again
+_parsed_snapshots = OrderedDict()
+
+async def fetch_train_snapshot(provider, train_number, now_ms=None):
+    """Fetch a train once and return the content-state fields refreshed by periodic_updates,
+    with the countdown to the next stop taken at now_ms (the cycle's clock)."""
+    if now_ms is None:
+        now_ms = now_millis()
+    if provider == "Trenitalia":
+        document, parse = await fetch_train_info(train_number), parse_trenitalia
+    else:
+        document, parse = await ItaloAPI().call(train_number), parse_italo
+
+    key = (provider, str(train_number))
+    parsed = _parsed_snapshots.get(key)
+    if parsed is None or parsed[0] is not document:
+        parsed = _parsed_snapshots[key] = (document, parse(document, now_ms))
+        while len(_parsed_snapshots) > upstream_cache.max_entries:
+            _parsed_snapshots.popitem(last=False)
+    _parsed_snapshots.move_to_end(key)
+    return parsed[1].countdown(now_ms)
 
 app = FastAPI()
 
 # Set up logging
 log_level = os.environ.get("LOG_LEVEL", "INFO").upper()
-logging.basicConfig(
-    level=getattr(logging, log_level),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+# Fraction of pushes whose payload is logged at INFO (every push is logged at DEBUG)
+LOG_PUSH_SAMPLE_RATE = float(os.environ.get("LOG_PUSH_SAMPLE_RATE", "0.01"))
+
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler that enqueues records as they are. The stock `prepare` interpolates
+    the message on the calling thread so records can be pickled; ours never leave the
+    process, so interpolation is left to the listener's formatter too."""
+
+    def prepare(self, record):
+        return record
+
+def setup_logging():
+    """Route all records through a queue so message interpolation, formatting and
+    I/O happen on a listener thread instead of the event loop."""
+    if LOG_FORMAT == "json":
+        formatter = jsonlogger.JsonFormatter('%(asctime)s %(name)s %(levelname)s %(message)s')
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler = logging.StreamHandler()
+    handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(getattr(logging, log_level))
+    root.handlers = [DeferredQueueHandler(log_queue)]
+    # httpx logs every request at INFO, one line per push with the full device token in the url
+    for name in ("httpx", "httpcore"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 logger.info(f"Starting server with log level: {log_level}")
 
+def short_token(token):
+    """Shortened push token for log lines."""
+    return token[:8] + "..." if token and len(token) > 8 else token
+
+def sample_push_detail():
+    return logger.isEnabledFor(logging.DEBUG) or random.random() < LOG_PUSH_SAMPLE_RATE
+
 # Your existing configuration stays the same
 TEAM_ID = os.environ.get("TEAM_ID", "7QM8T4XA98")
 KEY_ID = os.environ.get("KEY_ID", "54QRS283BA")
 BUNDLE_ID = os.environ.get("BUNDLE_ID", "francescoparadis.Trainss")
 APNS_HOST = os.environ.get("APNS_HOST", "api.sandbox.push.apple.com")
 APNS_PORT = int(os.environ.get("APNS_PORT", "443"))
+APNS_SCHEME = os.environ.get("APNS_SCHEME", "https")
+
+# Periodic update pipeline settings
+POLL_MIN_INTERVAL = float(os.environ.get("POLL_MIN_INTERVAL", "10"))
+POLL_MAX_INTERVAL = float(os.environ.get("POLL_MAX_INTERVAL", "300"))
+POLL_JITTER = float(os.environ.get("POLL_JITTER", "0.1"))
+SCHEDULER_TICK = float(os.environ.get("SCHEDULER_TICK", "1"))
+ACTIVITY_RETIRE_GRACE = float(os.environ.get("ACTIVITY_RETIRE_GRACE", "1800"))
+UPSTREAM_CONCURRENCY = int(os.environ.get("UPSTREAM_CONCURRENCY", "8"))
+APNS_CONCURRENCY = int(os.environ.get("APNS_CONCURRENCY", "32"))
+TRAIN_UPDATE_TIMEOUT = float(os.environ.get("TRAIN_UPDATE_TIMEOUT", "30"))
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "5000"))
+
+# APNs connection pool settings
+APNS_POOL_SIZE = int(os.environ.get("APNS_POOL_SIZE", "2"))
+APNS_TIMEOUT = float(os.environ.get("APNS_TIMEOUT", "30"))
+# Apple rejects tokens older than an hour and throttles refreshes more frequent than every 20 minutes
+APNS_TOKEN_REFRESH = min(max(int(os.environ.get("APNS_TOKEN_REFRESH", "2400")), 1200), 3600)
+APNS_BACKOFF_MAX = float(os.environ.get("APNS_BACKOFF_MAX", "300"))
+APNS_RETRY_QUEUE_SIZE = int(os.environ.get("APNS_RETRY_QUEUE_SIZE", "1000"))
+APNS_MAX_RETRIES = int(os.environ.get("APNS_MAX_RETRIES", "3"))
+
+# Change detection: fields whose changes alone only warrant a low-priority push,
+# and the longest an activity may go without any push
+COSMETIC_FIELDS = ("tempoProssimaStazione",)
+PUSH_KEEPALIVE_INTERVAL = float(os.environ.get("PUSH_KEEPALIVE_INTERVAL", "900"))
+
+# APNs payload encoding
+try:
+    import orjson
+except ImportError:  # Optional: the stdlib encoder is used without it
+    orjson = None
+
+# Content-state fields that come from the train rather than the activity (COSMETIC_FIELDS is a subset)
+SNAPSHOT_FIELDS = TrainSnapshot.FIELDS
+
+def dumps(value):
+    """Encode a JSON value to compact bytes with sorted keys, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(value, default=str, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(value, default=str, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode()
+
+def encode_fields(fields):
+    """Encode a dict as JSON object members without the braces, so fragments can be
+    spliced into one object. Returns the members and their digest."""
+    members = dumps(fields)[1:-1]
+    return members, hashlib.sha1(members).hexdigest()
+
+def encode_snapshot(fields):
+    """Encode the train part of a content-state once: (meaningful, cosmetic) fragments."""
+    meaningful = {name: fields.get(name) for name in SNAPSHOT_FIELDS if name not in COSMETIC_FIELDS}
+    cosmetic = {name: fields.get(name) for name in COSMETIC_FIELDS}
+    return encode_fields(meaningful), encode_fields(cosmetic)
+
+
+class ContentState:
+    """A content-state pre-encoded as (members, digest) fragments: the activity's own
+    fields, the meaningful train fields and the cosmetic ones. A train's fragments are
+    encoded once per poll and shared by every token following it."""
+
+    __slots__ = ("activity", "meaningful", "cosmetic")
+
+    def __init__(self, activity, meaningful, cosmetic):
+        self.activity = activity
+        self.meaningful = meaningful
+        self.cosmetic = cosmetic
+
+    @classmethod
+    def from_dict(cls, content_state):
+        meaningful, cosmetic = encode_snapshot(content_state)
+        return cls(ActivityRecord(content_state).fragment(), meaningful, cosmetic)
+
+    def digests(self):
+        """Digests of the meaningful and the cosmetic parts, for change detection."""
+        return self.activity[1] + self.meaningful[1], self.cosmetic[1]
+
+    def members(self):
+        return b",".join(members for members, _ in (self.activity, self.meaningful, self.cosmetic) if members)
+
+def encode_payload(event, timestamp, content_state, extra=b""):
+    """The APNs payload bytes; `event` goes first so payload_event can read it back."""
+    return b'{"aps":{"event":"%s","timestamp":%d,"content-state":{%s}%s}}' % (
+        event.encode(), timestamp, content_state.members(), extra)
+
+UPDATE_PAYLOAD_EXTRA = b',"relevance-score":100.0'
+_EVENT_OFFSET = len(b'{"aps":{"event":"')
+
+def payload_event(payload):
+    return payload[_EVENT_OFFSET:payload.index(b'"', _EVENT_OFFSET)].decode()
+
+APNS_STATIC_HEADERS = {
+    'apns-push-type': 'liveactivity',
+    'apns-topic': f'{BUNDLE_ID}.push-type.liveactivity',
+    'apns-expiration': '0',
+    'content-type': 'application/json'
+}
+_apns_headers = {}
+
+def apns_headers(jwt_token, priority):
+    """Header set of a push, built once per provider token and priority."""
+    headers = _apns_headers.get((jwt_token, priority))
+    if headers is None:
+        if len(_apns_headers) >= 4:
+            _apns_headers.clear()  # The provider token was refreshed
+        headers = dict(APNS_STATIC_HEADERS)
+        headers['authorization'] = f'bearer {jwt_token}'
+        headers['apns-priority'] = str(priority)
+        _apns_headers[(jwt_token, priority)] = headers
+    return headers
+
+# Activity storage
+ACTIVITY_STORE = os.environ.get("ACTIVITY_STORE", "sqlite")
+ACTIVITY_STORE_PATH = os.environ.get("ACTIVITY_STORE_PATH", "activities.db")
+STORE_FLUSH_INTERVAL = float(os.environ.get("STORE_FLUSH_INTERVAL", "1"))
+
+# Activity fields specific to one rider; the rest are shared by everyone on the same train
+RIDER_FIELDS = ("push_token", "seat", "train_id")
+TRAIN_FIELDS = (
+    "problemi", "programmato", "tracciato", "stazionePartenza", "orarioPartenza", "stazioneArrivo",
+    "orarioArrivo", "dataPartenza", "dataArrivo", "numeroTreno", "provider"
+)
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+class TrainState:
+    """Activity fields shared by the riders of a train, interned: equal states are
+    one object, dropped once the last activity referencing it is gone."""
+
+    __slots__ = TRAIN_FIELDS + ("_fragment", "__weakref__")
+
+    _interned = weakref.WeakValueDictionary()
+
+    @classmethod
+    def intern(cls, values):
+        state = cls._interned.get(values)
+        if state is None:
+            state = cls.__new__(cls)
+            for name, value in zip(TRAIN_FIELDS, values):
+                setattr(state, name, _intern(value))
+            state._fragment = None
+            cls._interned[values] = state
+        return state
+
+    def fragment(self):
+        """JSON members of the shared fields, encoded once per state."""
+        if self._fragment is None:
+            self._fragment = dumps({name: getattr(self, name) for name in TRAIN_FIELDS})[1:-1]
+        return self._fragment
+
+class ActivityRecord:
+    """One rider's activity: the rider's own fields, the shared TrainState and the
+    train fields (SNAPSHOT_FIELDS) as last sent by the app, in place of the
+    TrainUpdate dict. Reads like a read-only dict through `get` and `[]`."""
+
+    __slots__ = ("push_token", "seat", "train_id", "train", "snapshot", "extra", "_fragment")
+
+    def __init__(self, data):
+        self.push_token = data.get("push_token")
+        self.seat = data.get("seat")
+        self.train_id = data.get("train_id")
+        self.train = TrainState.intern(tuple(data.get(name) for name in TRAIN_FIELDS))
+        self.snapshot = tuple(_intern(data.get(name)) for name in SNAPSHOT_FIELDS)
+        # Fields outside the TrainUpdate model, kept so nothing is lost on a round trip
+        extra = {k: v for k, v in data.items() if k not in _RECORD_FIELDS}
+        self.extra = extra or None
+        self._fragment = None
+
+    def get(self, name, default=None):
+        if name in _TRAIN_FIELD_SET:
+            return getattr(self.train, name)
+        if name in _SNAPSHOT_INDEX:
+            return self.snapshot[_SNAPSHOT_INDEX[name]]
+        if name in _RIDER_FIELD_SET:
+            return getattr(self, name)
+        if self.extra is not None:
+            return self.extra.get(name, default)
+        return default
+
+    def __getitem__(self, name):
+        value = self.get(name, _MISSING)
+        if value is _MISSING:
+            raise KeyError(name)
+        return value
+
+    def as_dict(self):
+        data = {name: getattr(self, name) for name in RIDER_FIELDS}
+        data.update(zip(SNAPSHOT_FIELDS, self.snapshot))
+        data.update((name, getattr(self.train, name)) for name in TRAIN_FIELDS)
+        if self.extra is not None:
+            data.update(self.extra)
+        return data
+
+    def fragment(self):
+        """(members, digest) of the content-state fields owned by this activity: everything
+        but the push token and the train fields refreshed by every poll."""
+        if self._fragment is None:
+            rider = {"seat": self.seat, "train_id": self.train_id}
+            if self.extra is not None:
+                rider.update((k, v) for k, v in self.extra.items() if k not in SNAPSHOT_FIELDS)
+            members = self.train.fragment() + b"," + dumps(rider)[1:-1]
+            self._fragment = (members, hashlib.sha1(members).hexdigest())
+        return self._fragment
+
+_MISSING = object()
+_RIDER_FIELD_SET = frozenset(RIDER_FIELDS)
+_TRAIN_FIELD_SET = frozenset(TRAIN_FIELDS)
+_SNAPSHOT_INDEX = {name: index for index, name in enumerate(SNAPSHOT_FIELDS)}
+_RECORD_FIELDS = _RIDER_FIELD_SET | _TRAIN_FIELD_SET | frozenset(SNAPSHOT_FIELDS)
+
+def activity_record(data):
+    """An ActivityRecord for stored activity data; `{}` (registered, no activity yet) stays as is."""
+    return ActivityRecord(data) if data else data
+
+class MemoryBackend:
+    """Keeps nothing beyond the process: activities are lost on restart."""
+
+    def load(self):
+        return []
+
+    def get(self, token):
+        return None
+
+    def sequence(self):
+        return 0
+
+    def changes_since(self, seq):
+        return []
+
+    def write_batch(self, upserts, deletes):
+        pass
+
+    def load_last_sent(self):
+        return []
+
+    def save_last_sent(self, rows):
+        pass
+
+    def take_pending_ends(self):
+        return []
+
+    def save_pending_ends(self, rows):
+        pass
+
+    def close(self):
+        pass
+
+class SQLiteBackend:
+    """Embedded SQLite database in WAL mode, one row per push token.
+
+    `data` holds the activity as JSON: NULL for a token without an activity and
+    '{}' for a registered token still waiting for its first update. Removed
+    tokens are kept as tombstones (`deleted = 1`) for a day so that other
+    worker processes sharing the file see the removal in `changes_since`.
+
+    Every batch stamps its rows with `seq`, taken from a counter in the `meta`
+    table once the write lock is held: a batch that waited for the lock still
+    commits after every lower `seq`, so readers resuming from the last `seq`
+    they saw never skip a row the way a wall-clock window could. The counter
+    lives apart from the rows because tombstones holding the highest `seq` get
+    deleted, and a MAX() over the rows would then hand out numbers again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS activities ("
+            "token TEXT PRIMARY KEY, train_id TEXT, provider TEXT, numero_treno TEXT, data TEXT, "
+            "updated_at REAL NOT NULL DEFAULT 0, deleted INTEGER NOT NULL DEFAULT 0, seq INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(activities)")}
+        if "updated_at" not in columns:
+            self._conn.execute("ALTER TABLE activities ADD COLUMN updated_at REAL NOT NULL DEFAULT 0")
+            self._conn.execute("ALTER TABLE activities ADD COLUMN deleted INTEGER NOT NULL DEFAULT 0")
+        if "seq" not in columns:
+            self._conn.execute("ALTER TABLE activities ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS activities_train ON activities (provider, numero_treno)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS activities_updated ON activities (updated_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS activities_seq ON activities (seq)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        # Seeded from the rows of a file written before the counter, ahead of any tombstone cleanup
+        self._conn.execute("INSERT OR IGNORE INTO meta SELECT 'seq', COALESCE(MAX(seq), 0) FROM activities")
+        self._conn.execute("DELETE FROM activities WHERE deleted = 1 AND updated_at < ?", (time.time() - 86400,))
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS last_sent ("
+            "token TEXT PRIMARY KEY, digest TEXT NOT NULL, cosmetic_digest TEXT NOT NULL, sent_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pending_ends ("
+            "token TEXT PRIMARY KEY, payload BLOB NOT NULL, priority INTEGER NOT NULL, apns_id TEXT, "
+            "attempt INTEGER NOT NULL, due REAL NOT NULL)"
+        )
+
+    def load(self):
+        return self._conn.execute("SELECT token, train_id, data FROM activities WHERE deleted = 0").fetchall()
+
+    def get(self, token):
+        return self._conn.execute(
+            "SELECT token, train_id, data, deleted FROM activities WHERE token = ?", (token,)
+        ).fetchone()
+
+    def sequence(self):
+        return self._conn.execute("SELECT value FROM meta WHERE key = 'seq'").fetchone()[0]
+
+    def changes_since(self, seq):
+        """Rows written after batch `seq`, as (token, train_id, data, deleted, seq) in commit order."""
+        return self._conn.execute(
+            "SELECT token, train_id, data, deleted, seq FROM activities WHERE seq > ? ORDER BY seq", (seq,)
+        ).fetchall()
+
+    def write_batch(self, upserts, deletes):
+        rows = [
+            (token, train_id, data.get("provider") if data else None, data.get("numeroTreno") if data else None,
+             None if data is None else json.dumps(data))
+            for token, train_id, data in upserts
+        ]
+        with self._conn:
+            # IMMEDIATE takes the write lock up front, so the sequence and the timestamp
+            # are read after any wait for it
+            self._conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            self._conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'seq'")
+            seq = self.sequence()
+            if rows:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO activities "
+                    "(token, train_id, provider, numero_treno, data, updated_at, deleted, seq) "
+                    "VALUES (?, ?, ?, ?, ?, ?, 0, ?)",
+                    [row + (now, seq) for row in rows]
+                )
+            if deletes:
+                self._conn.executemany(
+                    "UPDATE activities SET train_id = NULL, provider = NULL, numero_treno = NULL, data = NULL, "
+                    "updated_at = ?, deleted = 1, seq = ? WHERE token = ?",
+                    [(now, seq, token) for token in deletes]
+                )
+
+    def load_last_sent(self):
+        return self._conn.execute("SELECT token, digest, cosmetic_digest, sent_at FROM last_sent").fetchall()
+
+    def save_last_sent(self, rows):
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT OR REPLACE INTO last_sent VALUES (?, ?, ?, ?)", rows)
+            # Entries of ended activities are no use to the next process
+            self._conn.execute(
+                "DELETE FROM last_sent WHERE token NOT IN "
+                "(SELECT token FROM activities WHERE deleted = 0 AND data IS NOT NULL)"
+            )
+
+    def take_pending_ends(self):
+        """Claim the `end` pushes a stopped process left unsent: each worker sharing the
+        file takes them at most once."""
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            rows = self._conn.execute(
+                "SELECT token, payload, priority, apns_id, attempt, due FROM pending_ends"
+            ).fetchall()
+            self._conn.execute("DELETE FROM pending_ends")
+        return rows
+
+    def save_pending_ends(self, rows):
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT OR REPLACE INTO pending_ends VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def close(self):
+        self._conn.close()
+
+class ActivityStore:
+    """Registered tokens and their activities, indexed by token and by train.
+
+    `tokens` and `activities` are the in-memory view read on the hot path;
+    every change marks the token dirty and a background task writes the dirty
+    tokens to the backend in one batch, so storage latency never reaches the
+    request path. `version` changes whenever a train gains its first activity
+    or loses its last, so the scheduler re-reads the trains only then.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.tokens = {}
+        self.activities = {}
+        self.by_train = {}
+        self.version = 0
+        self._dirty = set()
+        self._synced_seq = 0
+        self._writing = None
+        self.flushes = 0
+
+    @staticmethod
+    def _train_key(data):
+        return (data.train.provider, data.train.numeroTreno) if data else None
+
+    def _index(self, token, data):
+        if data:
+            key = self._train_key(data)
+            train_tokens = self.by_train.get(key)
+            if train_tokens is None:
+                train_tokens = self.by_train[key] = set()
+                self.version += 1
+            train_tokens.add(token)
+
+    def _unindex(self, token):
+        data = self.activities.get(token)
+        if data:
+            key = self._train_key(data)
+            train_tokens = self.by_train.get(key)
+            if train_tokens is not None:
+                train_tokens.discard(token)
+                if not train_tokens:
+                    del self.by_train[key]
+                    self.version += 1
+
+    def register(self, token, train_id):
+        self._unindex(token)
+        self.tokens[token] = train_id
+        self.activities[token] = {}
+        self._dirty.add(token)
+
+    def put(self, token, data):
+        """Store activity data (a TrainUpdate dict) as a compact record and return the record."""
+        record = activity_record(data)
+        key = self._train_key(record)
+        if key is not None and key == self._train_key(self.activities.get(token)):
+            # Same train: already indexed, and the train's last token must not flicker out
+            self.activities[token] = record
+        else:
+            self._unindex(token)
+            self.activities[token] = record
+            self._index(token, record)
+        self._dirty.add(token)
+        return record
+
+    def end(self, token):
+        """Drop the activity but keep the token registered."""
+        if token in self.activities:
+            self._unindex(token)
+            del self.activities[token]
+            self._dirty.add(token)
+
+    def remove(self, token):
+        self.end(token)
+        if self.tokens.pop(token, None) is not None:
+            self._dirty.add(token)
+
+    def _apply(self, token, train_id, data, deleted):
+        """Apply a row written by another worker without marking it dirty again."""
+        if token in self._dirty:
+            return  # Our own pending change is newer
+        self._unindex(token)
+        if deleted:
+            self.tokens.pop(token, None)
+            self.activities.pop(token, None)
+            return
+        self.tokens[token] = train_id
+        if data is None:
+            self.activities.pop(token, None)
+        else:
+            activity = activity_record(json.loads(data))
+            self.activities[token] = activity
+            self._index(token, activity)
+
+    async def lookup(self, token):
+        """Whether token is registered, reading through to the backend for tokens
+        registered by another worker and not synced here yet."""
+        if token in self.tokens:
+            return True
+        row = await asyncio.to_thread(self.backend.get, token)
+        if row is None:
+            return False
+        self._apply(*row)
+        return token in self.tokens
+
+    async def sync(self):
+        """Pull the changes other workers wrote to the shared backend."""
+        rows = await asyncio.to_thread(self.backend.changes_since, self._synced_seq)
+        for token, train_id, data, deleted, seq in rows:
+            self._apply(token, train_id, data, deleted)
+            self._synced_seq = seq
+        return len(rows)
+
+    async def sync_loop(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sync()
+            except Exception as e:
+                logger.error(f"Error syncing activities from storage: {str(e)}")
+
+    def pending_writes(self):
+        return len(self._dirty)
+
+    def restore(self):
+        started = time.perf_counter()
+        # Read before loading: a batch committed in between is applied again by sync, harmlessly
+        self._synced_seq = self.backend.sequence()
+        rows = self.backend.load()
+        # Decoding every activity as one JSON array is much cheaper than one json.loads per row
+        payloads = iter(json.loads("[" + ",".join(data for _, _, data in rows if data is not None) + "]"))
+        for token, train_id, data in rows:
+            self.tokens[token] = train_id
+            if data is not None:
+                activity = activity_record(next(payloads))
+                self.activities[token] = activity
+                self._index(token, activity)
+        logger.info(f"Restored {len(self.tokens)} tokens and {len(self.activities)} activities in {(time.perf_counter() - started) * 1000:.1f}ms")
+
+    async def flush(self):
+        if self._writing is not None and not self._writing.done():
+            # A cancelled flush leaves its write running in the thread; let it finish first
+            await asyncio.wait([self._writing])
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        upserts = []
+        deletes = []
+        for token in dirty:
+            if token in self.tokens:
+                data = self.activities.get(token)
+                upserts.append((token, self.tokens[token], data.as_dict() if data else data))
+            else:
+                deletes.append(token)
+        self._writing = asyncio.ensure_future(asyncio.to_thread(self.backend.write_batch, upserts, deletes))
+        try:
+            await asyncio.shield(self._writing)
+            self.flushes += 1
+        except asyncio.CancelledError:
+            # Shutdown cancelled the flush loop: keep the tokens dirty for the final flush
+            self._dirty |= dirty
+            raise
+        except Exception as e:
+            # Keep the tokens dirty so the next flush retries them
+            self._dirty |= dirty
+            logger.error(f"Error writing {len(dirty)} activities to storage: {str(e)}")
+
+    async def flush_loop(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+    def restore_sent(self):
+        """Last content-state pushed per token, as checkpointed by the previous process."""
+        return {
+            token: {"digest": digest, "cosmetic_digest": cosmetic_digest, "sent_at": sent_at}
+            for token, digest, cosmetic_digest, sent_at in self.backend.load_last_sent()
+            if self.activities.get(token)
+        }
+
+    def restore_pending_ends(self):
+        """`end` pushes the previous process could not send before it stopped."""
+        return self.backend.take_pending_ends()
+
+    async def checkpoint_pending_ends(self, rows):
+        await asyncio.to_thread(self.backend.save_pending_ends, rows)
+        return len(rows)
+
+    async def checkpoint_sent(self, sent):
+        """Save what was last pushed to each activity, so the next process does not push it again."""
+        rows = [
+            (token, entry["digest"], entry["cosmetic_digest"], entry["sent_at"])
+            for token, entry in sent.items() if self.activities.get(token)
+        ]
+        await asyncio.to_thread(self.backend.save_last_sent, rows)
+        return len(rows)
+
+    def close(self):
+        self.backend.close()
+
+def create_backend(kind, path):
+    if kind == "sqlite":
+        return SQLiteBackend(path)
+    if kind == "memory":
+        return MemoryBackend()
+    raise ValueError(f"Unknown ACTIVITY_STORE {kind!r}, expected 'sqlite' or 'memory'")
+
+store = ActivityStore(create_backend(ACTIVITY_STORE, ACTIVITY_STORE_PATH))
 
 # Store tokens and activities
-tokens = {}
-active_activities = {}
+tokens = store.tokens
+active_activities = store.activities
+
+# Multi-worker sharding
+SHARDED_WORKERS = os.environ.get("SHARDED_WORKERS", "0") == "1"
+WORKER_HEARTBEAT = float(os.environ.get("WORKER_HEARTBEAT", "2"))
+WORKER_TTL = float(os.environ.get("WORKER_TTL", "10"))
+STORE_SYNC_INTERVAL = float(os.environ.get("STORE_SYNC_INTERVAL", "1"))
+
+class HashRing:
+    """Consistent hash ring mapping train numbers to worker ids."""
+
+    def __init__(self, nodes, vnodes=64):
+        self.nodes = sorted(nodes)
+        self._ring = sorted((self._hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._points = [point for point, _ in self._ring]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+    def owner(self, key):
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._points, self._hash(str(key))) % len(self._ring)
+        return self._ring[index][1]
+
+class ShardCoordinator:
+    """Membership of the worker processes sharing one SQLite store.
+
+    Every worker heartbeats into the `workers` table; the live workers form a
+    consistent hash ring on train number, so each train is polled by exactly
+    one owner. When a worker stops heartbeating for `ttl` seconds its trains
+    move to the survivors on their next heartbeat.
+    """
+
+    def __init__(self, path, worker_id, ttl=10.0):
+        self.worker_id = worker_id
+        self.ttl = ttl
+        self.ring = HashRing([worker_id])
+        self.rebalances = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS workers (worker_id TEXT PRIMARY KEY, heartbeat REAL NOT NULL)")
+
+    def heartbeat(self):
+        now = time.time()
+        with self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO workers VALUES (?, ?)", (self.worker_id, now))
+            self._conn.execute("DELETE FROM workers WHERE heartbeat < ?", (now - self.ttl * 6,))
+        live = [row[0] for row in self._conn.execute("SELECT worker_id FROM workers WHERE heartbeat >= ?", (now - self.ttl,))]
+        if sorted(live) != self.ring.nodes:
+            self.ring = HashRing(live)
+            self.rebalances += 1
+            logger.info(f"Worker {self.worker_id} rebalanced across {len(live)} live workers")
+
+    def owns(self, train_number):
+        return self.ring.owner(train_number) == self.worker_id
+
+    def leave(self):
+        with self._conn:
+            self._conn.execute("DELETE FROM workers WHERE worker_id = ?", (self.worker_id,))
+        self._conn.close()
+
+    async def run(self, interval):
+        while True:
+            try:
+                await asyncio.to_thread(self.heartbeat)
+            except Exception as e:
+                logger.error(f"Worker heartbeat failed: {str(e)}")
+            await asyncio.sleep(interval)
+
+    def state(self):
+        return {"worker_id": self.worker_id, "workers": self.ring.nodes, "rebalances": self.rebalances}
+
+shard = None
+if SHARDED_WORKERS:
+    if ACTIVITY_STORE != "sqlite":
+        raise RuntimeError("SHARDED_WORKERS requires ACTIVITY_STORE=sqlite so workers can share activities")
+    shard = ShardCoordinator(ACTIVITY_STORE_PATH, f"{socket.gethostname()}-{os.getpid()}", ttl=WORKER_TTL)
+
+def owned_trains():
+    """(provider, numeroTreno) of the trains this process polls: all of them, or its share
+    of the hash ring in sharded mode."""
+    if shard is None:
+        return set(store.by_train)
+    return {key for key in store.by_train if shard.owns(key[1])}
+
+def trains_version():
+    """Changes whenever the result of owned_trains may have."""
+    return (store.version, shard.rebalances if shard is not None else 0)
+
+# Counters of the periodic polls: running totals of trains fetched vs. tokens served, and the last poll
+cycle_stats = {
+    "polls": 0,
+    "last_poll": None,
+    "totals": {"trains_fetched": 0, "tokens_served": 0, "sent": 0, "sent_low_priority": 0, "skipped": 0}
+}
+# (time, train, fetched, tokens, pushes, skipped) of the polls within the last CYCLE_WINDOW seconds
+CYCLE_WINDOW = 60
+recent_polls = deque()
+
+def recent_cycle(now):
+    """Unique trains fetched vs. tokens served over the last CYCLE_WINDOW seconds, the view one
+    cycle over every train used to give."""
+    while recent_polls and recent_polls[0][0] < now - CYCLE_WINDOW:
+        recent_polls.popleft()
+    return {
+        "seconds": CYCLE_WINDOW,
+        "polls": len(recent_polls),
+        "unique_trains": len({poll[1] for poll in recent_polls}),
+        "trains_fetched": sum(poll[2] for poll in recent_polls),
+        "tokens_served": sum(poll[3] for poll in recent_polls),
+        "pushes": sum(poll[4] for poll in recent_polls),
+        "skipped": sum(poll[5] for poll in recent_polls)
+    }
+
+# Last content-state pushed per token, used to skip pushes that would change nothing
+last_sent = {}
 
 # Pydantic models for request validation
 class TokenRegistration(BaseModel):
@@ -336,241 +1614,1218 @@ class TrainUpdate(BaseModel):
     numeroTreno: Optional[str] = None
     provider: str
 
-async def ping_server():
-    """Pings the server to keep it active."""
-    while True:
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get("http://127.0.0.1:8000/")
-                logger.info(f"Self-ping status: {response.status_code}")
-        except Exception as e:
-            logger.error(f"Self-ping failed: {str(e)}")
-        await asyncio.sleep(300)
+class ProviderTokenCache:
+    """Signed APNs provider JWT reused for its allowed lifetime.
+
+    The key is decoded and parsed once; the ES256 token is re-signed only when
+    it is older than `refresh_after` seconds (Apple rejects tokens older than an
+    hour and throttles refreshes more frequent than every 20 minutes). Signing
+    is synchronous, so concurrent senders on the event loop always observe the
+    same cached token.
+    """
+
+    MIN_REFRESH_INTERVAL = 1200
+
+    def __init__(self, team_id, key_id, refresh_after=2400):
+        self.team_id = team_id
+        self.key_id = key_id
+        self.refresh_after = refresh_after
+        self._key = None
+        self.token = None
+        self.issued_at = 0
+        # Last token reported as InvalidProviderToken, logged once
+        self.rejected = None
+
+    def _load_key(self):
+        if self._key is None:
+            # Get the base64-encoded auth key from environment variables
+            auth_key = os.environ.get('APNS_AUTH_KEY')
+            if not auth_key:
+                logger.error("APNS_AUTH_KEY environment variable not found")
+                raise HTTPException(status_code=500, detail="APNS authentication key not found")
+            self._key = serialization.load_pem_private_key(base64.b64decode(auth_key), password=None)
+        return self._key
+
+    def age(self):
+        return int(time.time()) - self.issued_at if self.token else None
+
+    def refresh(self):
+        started = time.perf_counter()
+        issued_at = int(time.time())
+        self.token = jwt.encode(
+            {
+                'iss': self.team_id,
+                'iat': issued_at
+            },
+            self._load_key(),
+            algorithm='ES256',
+            headers={
+                'kid': self.key_id,
+                'typ': 'JWT'
+            }
+        )
+        self.issued_at = issued_at
+        JWT_SIGN_SECONDS.observe(time.perf_counter() - started)
+        logger.info("Signed new APNs provider token")
+        return self.token
+
+    def get(self):
+        if self.token is None or self.age() >= self.refresh_after:
+            JWT_REQUESTS.inc("signed")
+            return self.refresh()
+        JWT_REQUESTS.inc("cached")
+        return self.token
+
+    def invalidate(self, rejected, reason):
+        """Drop the cached token after APNs rejected `rejected` as ExpiredProviderToken.
+
+        Nothing is re-signed when the token was already replaced (pushes sent with
+        the old one keep failing for a while), when it is younger than Apple's
+        20-minute refresh limit (a clock problem a new token would not fix), or for
+        InvalidProviderToken, which is permanent: wrong key, team or key id. Any of
+        these would re-sign on every push round and trip TooManyProviderTokenUpdates.
+        """
+        if rejected != self.token:
+            return
+        if reason != "ExpiredProviderToken":
+            if self.rejected != rejected:
+                self.rejected = rejected
+                logger.error("APNs rejects the provider token as %s: check APNS_AUTH_KEY, KEY_ID and TEAM_ID", reason)
+            return
+        if self.age() < self.MIN_REFRESH_INTERVAL:
+            logger.warning("APNs reports a %ss old provider token as expired; check the server clock", self.age())
+            return
+        self.token = None
+
+    async def refresh_loop(self):
+        """Re-sign the token shortly before it is due so senders never pay for it."""
+        while True:
+            age = self.age()
+            # A minute ahead of the deadline; without a token (no key yet) retry every minute
+            due_in = 60 if age is None else self.refresh_after - 60 - age
+            await asyncio.sleep(max(due_in, 1))
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Error refreshing APNs provider token: {str(e)}")
+
+provider_tokens = ProviderTokenCache(TEAM_ID, KEY_ID, refresh_after=APNS_TOKEN_REFRESH)
 
 async def create_token():
-    """Create a JWT token for APNs authentication."""
+    """Return the cached JWT token for APNs authentication."""
     try:
-        # Get the base64-encoded auth key from environment variables
-        auth_key = os.environ.get('APNS_AUTH_KEY')
-        if not auth_key:
-            logger.error("APNS_AUTH_KEY environment variable not found")
-            raise HTTPException(status_code=500, detail="APNS authentication key not found")
-        
-        try:
-            # Decode base64 key
-            key_data = base64.b64decode(auth_key)
-            
-            # Create JWT token
-            token = jwt.encode(
-                {
-                    'iss': TEAM_ID,
-                    'iat': int(time.time())
-                },
-                key_data,
-                algorithm='ES256',
-                headers={
-                    'kid': KEY_ID,
-                    'typ': 'JWT'
-                }
-            )
-            return token
-        except Exception as e:
-            logger.error(f"Error decoding key or creating JWT: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Error creating JWT token: {str(e)}")
+        return provider_tokens.get()
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error creating JWT token: {str(e)}")
+        logger.error(f"Error decoding key or creating JWT: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error creating JWT token: {str(e)}")
 
-async def send_push_notification(token: str, payload: dict):
-    """Send push notification to APNs."""
+class APNsClientPool:
+    """Long-lived HTTP/2 connections to APNs shared by every push path.
+
+    Each client holds a single HTTP/2 connection and concurrent pushes are
+    multiplexed as streams over it; requests are spread round-robin across the
+    pool. A client whose connection was closed (GOAWAY) or failed is recreated
+    and the request retried once on the fresh connection.
+    """
+
+    def __init__(self, host, port=443, size=2, timeout=30.0, scheme="https"):
+        self.host = host
+        self.port = port
+        self.scheme = scheme
+        self.size = max(1, size)
+        self.timeout = timeout
+        self._clients = []
+        self._next = 0
+        self.reconnects = 0
+        self.last_ok = None
+        self.last_error = None
+        # Requests sent and not answered yet, awaited by the shutdown drain
+        self.inflight = 0
+
+    def _new_client(self):
+        return httpx.AsyncClient(
+            http2=True,
+            # Plain-text http means HTTP/2 with prior knowledge (h2c), used by local APNs stand-ins
+            http1=self.scheme == "https",
+            verify=True,
+            base_url=f"{self.scheme}://{self.host}:{self.port}",
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=1, max_keepalive_connections=1, keepalive_expiry=None)
+        )
+
+    async def start(self):
+        if not self._clients:
+            self._clients = [self._new_client() for _ in range(self.size)]
+            logger.info(f"Opened APNs pool with {self.size} HTTP/2 connections to {self.host}:{self.port}")
+
+    async def close(self):
+        clients, self._clients = self._clients, []
+        for client in clients:
+            await client.aclose()
+
+    async def _reconnect(self, index, client):
+        # Another sender may already have replaced this client
+        if index < len(self._clients) and self._clients[index] is client:
+            self._clients[index] = self._new_client()
+            self.reconnects += 1
+            logger.warning(f"Reconnecting APNs connection {index}")
+        await client.aclose()
+
+    async def post(self, path, headers, payload):
+        if not self._clients:
+            await self.start()
+        index = self._next % len(self._clients)
+        self._next += 1
+        self.inflight += 1
+        try:
+            for attempt in range(2):
+                client = self._clients[index]
+                try:
+                    response = await client.post(path, content=payload, headers=headers)
+                    self.last_ok = time.time()
+                    return response
+                except (httpx.RemoteProtocolError, httpx.ConnectError, httpx.ReadError, httpx.WriteError) as e:
+                    await self._reconnect(index, client)
+                    if attempt:
+                        self.last_error = time.time()
+                        raise
+                    logger.warning(f"APNs connection {index} failed ({str(e)}), retrying on a new connection")
+        finally:
+            self.inflight -= 1
+
+    def state(self):
+        return {
+            "host": self.host,
+            "connections": len(self._clients),
+            "inflight": self.inflight,
+            "reconnects": self.reconnects,
+            "last_ok": self.last_ok,
+            "last_error": self.last_error
+        }
+
+apns_pool = APNsClientPool(APNS_HOST, APNS_PORT, size=APNS_POOL_SIZE, timeout=APNS_TIMEOUT, scheme=APNS_SCHEME)
+
+# APNs reasons meaning the device token will never accept another push
+INVALID_TOKEN_REASONS = ("BadDeviceToken", "Unregistered", "DeviceTokenNotForTopic", "ExpiredToken")
+
+def classify_apns_response(status_code, reason):
+    """Map an APNs status code and reason to what the server should do about it."""
+    if status_code == 200:
+        return "delivered"
+    if status_code == 410 or reason in INVALID_TOKEN_REASONS:
+        return "invalid_token"
+    if status_code in (429, 503):
+        return "throttled"
+    if status_code == 403 and reason in ("ExpiredProviderToken", "InvalidProviderToken"):
+        return "provider_token"
+    if status_code >= 500:
+        return "transient"
+    return "rejected"
+
+class APNsBackoff:
+    """Exponential backoff per device token (429 TooManyRequests) and for the
+    whole provider (503 or provider-level 429s), keeping the apns-id of the
+    throttled push so the retry reuses it."""
+
+    def __init__(self, base=1.0, cap=300.0):
+        self.base = base
+        self.cap = cap
+        self.tokens = {}
+        self.global_until = 0.0
+        self.global_failures = 0
+
+    def remaining(self, token, now):
+        """Seconds before token may be pushed again (0 when it may be pushed now)."""
+        until = self.global_until
+        state = self.tokens.get(token)
+        if state is not None:
+            until = max(until, state["until"])
+        return max(0.0, until - now)
+
+    def _delay(self, failures):
+        return min(self.cap, self.base * 2 ** (failures - 1)) * random.uniform(0.8, 1.2)
+
+    def failure(self, token, apns_id, now, provider_wide=False):
+        if provider_wide:
+            self.global_failures += 1
+            self.global_until = now + self._delay(self.global_failures)
+            return self.global_until - now
+        state = self.tokens.setdefault(token, {"until": 0.0, "failures": 0, "apns_id": None})
+        state["failures"] += 1
+        state["until"] = now + self._delay(state["failures"])
+        state["apns_id"] = apns_id
+        return state["until"] - now
+
+    def success(self, token, now):
+        self.tokens.pop(token, None)
+        if self.global_failures and now >= self.global_until:
+            self.global_failures = 0
+
+    def forget(self, token):
+        self.tokens.pop(token, None)
+
+    def state(self, now):
+        return {
+            "global_backoff_seconds": round(max(0.0, self.global_until - now), 1),
+            "tokens_in_backoff": sum(1 for s in self.tokens.values() if s["until"] > now)
+        }
+
+class APNsRetryQueue:
+    """Bounded queue of pushes to retry after transient failures or throttling.
+
+    Holds at most one pending push per token (a newer push supersedes an older
+    one) and drops the oldest entry when full.
+    """
+
+    def __init__(self, max_size=1000, max_attempts=3):
+        self.max_size = max_size
+        self.max_attempts = max_attempts
+        self._entries = OrderedDict()
+        self.dropped = 0
+
+    def push(self, token, payload, priority, apns_id, attempt, due):
+        if attempt > self.max_attempts:
+            self.dropped += 1
+            return False
+        self._entries.pop(token, None)
+        self._entries[token] = (due, payload, priority, apns_id, attempt)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.dropped += 1
+        return True
+
+    def discard(self, token):
+        self._entries.pop(token, None)
+
+    def __contains__(self, token):
+        return token in self._entries
+
+    def pending(self, event):
+        """(token, payload, priority, apns_id, attempt, due) of the queued pushes of `event`."""
+        return [
+            (token, payload, priority, apns_id, attempt, due)
+            for token, (due, payload, priority, apns_id, attempt) in self._entries.items()
+            if payload_event(payload) == event
+        ]
+
+    def pop_due(self, now):
+        due = [(token, entry) for token, entry in self._entries.items() if entry[0] <= now]
+        for token, _ in due:
+            del self._entries[token]
+        return due
+
+    def __len__(self):
+        return len(self._entries)
+
+apns_backoff = APNsBackoff(cap=APNS_BACKOFF_MAX)
+apns_retries = APNsRetryQueue(max_size=APNS_RETRY_QUEUE_SIZE, max_attempts=APNS_MAX_RETRIES)
+apns_outcomes = {}
+
+def prune_token(token):
+    """Forget a token APNs reported as invalid so it is never pushed again."""
+    store.remove(token)
+    last_sent.pop(token, None)
+    apns_backoff.forget(token)
+    apns_retries.discard(token)
+    logger.info("Pruned invalid token %s", short_token(token))
+
+def handle_apns_outcome(token, outcome, reason, apns_id, payload, priority, attempt):
+    now = time.time()
+    apns_outcomes[outcome] = apns_outcomes.get(outcome, 0) + 1
+    if outcome == "delivered":
+        apns_backoff.success(token, now)
+        apns_retries.discard(token)
+    elif outcome == "invalid_token":
+        prune_token(token)
+    elif outcome == "throttled":
+        provider_wide = reason != "TooManyRequests"
+        delay = apns_backoff.failure(token, apns_id, now, provider_wide=provider_wide)
+        apns_retries.push(token, payload, priority, apns_id, attempt + 1, now + delay)
+    elif outcome in ("transient", "provider_token"):
+        # Provider token errors are retried once the cache has signed a new token
+        apns_retries.push(token, payload, priority, apns_id, attempt + 1, now + 2 ** attempt)
+
+async def send_push_notification(token: str, payload: bytes, priority: int = 10, apns_id: str = None, attempt: int = 0):
+    """Send push notification to APNs; `payload` is the encoded JSON body (see encode_payload)."""
     try:
+        wait = apns_backoff.remaining(token, time.time())
+        if wait > 0:
+            apns_outcomes["backoff"] = apns_outcomes.get("backoff", 0) + 1
+            if payload_event(payload) == "end":
+                # No later push supersedes an `end`: hold it until the backoff is over, or
+                # the Live Activity stays frozen on the device
+                apns_retries.push(token, payload, priority, apns_id, attempt, time.time() + wait)
+                return {"status": "error", "outcome": "backoff", "detail": f"Backing off for {wait:.1f}s, queued", "queued": True}
+            return {"status": "error", "outcome": "backoff", "detail": f"Backing off for {wait:.1f}s"}
+
         jwt_token = await create_token()
         
-        headers = {
-            'authorization': f'bearer {jwt_token}',
-            'apns-push-type': 'liveactivity',
-            'apns-topic': f'{BUNDLE_ID}.push-type.liveactivity',
-            'apns-expiration': '0',
-            'apns-priority': '10',
-            'content-type': 'application/json'
-        }
+        headers = apns_headers(jwt_token, priority)
+        if apns_id:
+            headers = dict(headers)
+            headers['apns-id'] = apns_id
         
-        url = f'https://{APNS_HOST}/3/device/{token}'
+        path = f'/3/device/{token}'
         
-        logger.info(f"Sending push notification to: {url}")
-        logger.info(f"Headers: {headers}")
-        logger.info(f"Payload: {json.dumps(payload, indent=2)}")
+        if sample_push_detail():
+            logger.info("Sending push to %s (priority %s): %s", short_token(token), priority, payload.decode())
         
-        async with httpx.AsyncClient(http2=True, verify=True) as client:
-            try:
-                response = await client.post(
-                    url=url,
-                    json=payload,
-                    headers=headers,
-                    timeout=30.0
-                )
+        try:
+            started = time.perf_counter()
+            response = await apns_pool.post(path, headers, payload)
+            APNS_SECONDS.observe(time.perf_counter() - started, str(priority))
 
-                logger.info(f"APNs response status: {response.status_code}")
-                logger.info(f"APNs response body: {response.text}")
-                
-                if response.status_code == 200:
-                    return {"status": "success"}
-                else:
-                    error_text = response.text
-                    logger.error(f"APNs error response: {error_text}")
-                    return {
-                        "status": "error",
-                        "code": response.status_code,
-                        "detail": error_text
-                    }
-            except httpx.RequestError as e:
-                logger.error(f"HTTP Request error: {str(e)}")
-                return {"status": "error", "detail": f"Request error: {str(e)}"}
-            except Exception as e:
-                logger.error(f"Error in HTTP request: {str(e)}")
-                return {"status": "error", "detail": str(e)}
+            logger.debug("APNs response %s for %s", response.status_code, short_token(token))
+            
+            apns_id = response.headers.get('apns-id', apns_id)
+            if response.status_code == 200:
+                APNS_RESPONSES.inc("200", "delivered")
+                handle_apns_outcome(token, "delivered", None, apns_id, payload, priority, attempt)
+                return {"status": "success", "apns_id": apns_id}
+            else:
+                error_text = response.text
+                try:
+                    reason = response.json().get("reason")
+                except ValueError:
+                    reason = None
+                outcome = classify_apns_response(response.status_code, reason)
+                APNS_RESPONSES.inc(str(response.status_code), outcome)
+                logger.error("APNs error response %s (%s) for %s: %s", response.status_code, outcome, short_token(token), error_text)
+                if outcome == "provider_token":
+                    # An expired provider token is re-signed for the next push
+                    provider_tokens.invalidate(jwt_token, reason)
+                handle_apns_outcome(token, outcome, reason, apns_id, payload, priority, attempt)
+                return {
+                    "status": "error",
+                    "code": response.status_code,
+                    "reason": reason,
+                    "outcome": outcome,
+                    "apns_id": apns_id,
+                    "detail": error_text
+                }
+        except httpx.RequestError as e:
+            logger.error("HTTP Request error for %s: %s", short_token(token), e)
+            APNS_RESPONSES.inc("none", "transient")
+            handle_apns_outcome(token, "transient", None, apns_id, payload, priority, attempt)
+            return {"status": "error", "outcome": "transient", "detail": f"Request error: {str(e)}"}
+        except Exception as e:
+            logger.error(f"Error in HTTP request: {str(e)}")
+            return {"status": "error", "detail": str(e)}
     except Exception as e:
         logger.error(f"Error sending push notification: {str(e)}")
         return {"status": "error", "detail": str(e)}
 
+async def resend_due_retries(now):
+    """Resend the queued pushes due by `now`, together; returns how many were sent."""
+    # Shared with the periodic updates, so retries and fresh pushes together stay within APNS_CONCURRENCY
+    apns_slots = shared_slots("apns", APNS_CONCURRENCY)
+
+    async def resend(token, payload, priority, apns_id, attempt):
+        async with apns_slots:
+            result = await send_push_notification(token, payload, priority=priority, apns_id=apns_id, attempt=attempt)
+        logger.debug("Retry %s for token %s: %s", attempt, short_token(token), result.get('status'))
+        if payload_event(payload) == "end":
+            forget_ended(token)
+
+    due = [
+        resend(token, payload, priority, apns_id, attempt)
+        for token, (_, payload, priority, apns_id, attempt) in apns_retries.pop_due(now)
+        # Skip activities ended or pruned meanwhile
+        if payload_event(payload) != "update" or token in active_activities
+    ]
+    if due:
+        await asyncio.gather(*due)
+    return len(due)
+
+async def apns_retry_loop():
+    """Resend queued pushes once their retry time has come."""
+    while not lifecycle.stopping:
+        await asyncio.sleep(1)
+        await resend_due_retries(time.time())
+
+def latency_summary(samples):
+    """Summarise latency samples (in milliseconds) as count/avg/p50/p95/max."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "avg": round(sum(ordered) / len(ordered), 2),
+        "p50": round(ordered[len(ordered) // 2], 2),
+        "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 2),
+        "max": round(ordered[-1], 2)
+    }
+
+def push_priority(token, content_state, now):
+    """Decide how to push a ContentState to token: None to skip, 5 for cosmetic changes
+    and keep-alives, 10 for meaningful changes."""
+    previous = last_sent.get(token)
+    if previous is None:
+        return 10
+    digest, cosmetic_digest = content_state.digests()
+    if digest != previous["digest"]:
+        return 10
+    if cosmetic_digest != previous["cosmetic_digest"]:
+        return 5
+    if now - previous["sent_at"] >= PUSH_KEEPALIVE_INTERVAL:
+        return 5
+    return None
+
+def remember_sent(token, content_state, now):
+    digest, cosmetic_digest = content_state.digests()
+    last_sent[token] = {"digest": digest, "cosmetic_digest": cosmetic_digest, "sent_at": now}
+
+async def push_periodic_update(token, encoded_snapshot, stats, apns_slots):
+    """Build and send the periodic update for one token from its train's encoded snapshot."""
+    try:
+        data = active_activities.get(token)
+        if not data:  # Activity ended while the train was being fetched
+            return
+
+        # The train's fields override the activity's own
+        content_state = ContentState(data.fragment(), *encoded_snapshot)
+
+        current_time = int(time.time())
+        priority = push_priority(token, content_state, current_time)
+        if priority is None:
+            stats["skipped"] += 1
+            return
+        if apns_backoff.remaining(token, current_time) > 0:
+            stats["backed_off"] += 1
+            return
+
+        payload = encode_payload("update", current_time, content_state, UPDATE_PAYLOAD_EXTRA)
+        
+        async with apns_slots:
+            started = time.perf_counter()
+            result = await send_push_notification(token, payload, priority=priority)
+            stats["push_ms"].append((time.perf_counter() - started) * 1000)
+        stats["pushes"] += 1
+        if priority == 5:
+            stats["pushes_low_priority"] += 1
+        
+        # If there was an error, log it but continue with other tokens
+        if result.get("status") == "error":
+            stats["push_errors"] += 1
+            logger.error("Error sending update to %s: %s", short_token(token), result.get('detail'))
+        else:
+            remember_sent(token, content_state, current_time)
+    except Exception as e:
+        stats["push_errors"] += 1
+        logger.error("Error processing update for token %s: %s", short_token(token), e)
+
+async def update_train(provider, train_number, train_tokens, stats, upstream_slots, apns_slots, snapshots=None, now_ms=None):
+    """Fetch one train and fan its snapshot out to every subscribed token."""
+    if not upstream_guard(provider).available(time.monotonic()):
+        # The provider's circuit is open: skip instead of queueing for a request that would be refused
+        stats["circuit_open"] += 1
+        return
+    try:
+        async with upstream_slots:
+            # The timeout covers the fetch alone: neither the wait for a slot nor the fan-out,
+            # whose pushes are bounded by APNS_TIMEOUT each
+            started = time.perf_counter()
+            snapshot = await asyncio.wait_for(fetch_train_snapshot(provider, train_number, now_ms), timeout=TRAIN_UPDATE_TIMEOUT)
+            stats["fetch_ms"].append((time.perf_counter() - started) * 1000)
+        stats["upstream_fetches"] += 1
+    except asyncio.TimeoutError:
+        stats["timeouts"] += 1
+        logger.error("Timed out fetching %s train %s after %ss", provider, train_number, TRAIN_UPDATE_TIMEOUT)
+        return
+    except Exception as e:
+        stats["fetch_errors"] += 1
+        logger.error("Error fetching %s train %s for %d tokens: %s", provider, train_number, len(train_tokens), e)
+        return
+
+    if snapshots is not None:
+        snapshots[(provider, train_number)] = snapshot
+    train_events.publish(provider, train_number, snapshot, now_ms or now_millis())
+    encoded_snapshot = encode_snapshot(snapshot.as_dict())
+    await asyncio.gather(*(push_periodic_update(token, encoded_snapshot, stats, apns_slots) for token in train_tokens))
+
+# Concurrency limits shared by every train being polled and, for "apns", by every other push
+# sender; created on first use in the running loop
+_shared_slots = {}
+
+def shared_slots(name, size):
+    slots = _shared_slots.get(name)
+    if slots is None:
+        slots = _shared_slots[name] = asyncio.Semaphore(size)
+    return slots
+
+async def run_update_cycle(subscribers, snapshots=None):
+    """Update the given trains within the shared upstream and APNs concurrency limits.
+
+    `subscribers` maps (provider, numeroTreno) to push tokens; when `snapshots`
+    is given it is filled with the snapshot fetched for each train.
+    """
+    cycle_started = time.perf_counter()
+    stats = {
+        "tokens": sum(len(train_tokens) for train_tokens in subscribers.values()),
+        "unique_trains": len(subscribers),
+        "upstream_fetches": 0,
+        "fetch_errors": 0,
+        "timeouts": 0,
+        "circuit_open": 0,
+        "pushes": 0,
+        "pushes_low_priority": 0,
+        "skipped": 0,
+        "backed_off": 0,
+        "push_errors": 0,
+        "fetch_ms": [],
+        "push_ms": []
+    }
+    upstream_slots = shared_slots("upstream", UPSTREAM_CONCURRENCY)
+    apns_slots = shared_slots("apns", APNS_CONCURRENCY)
+    # One clock for the whole cycle, so every countdown in it agrees
+    now_ms = now_millis()
+
+    # A slow train only costs its own subscribers: update_train times out its fetch
+    await asyncio.gather(*(
+        update_train(provider, train_number, train_tokens, stats, upstream_slots, apns_slots, snapshots, now_ms)
+        for (provider, train_number), train_tokens in subscribers.items()
+    ))
+
+    stats["fetch_ms"] = latency_summary(stats["fetch_ms"])
+    stats["push_ms"] = latency_summary(stats["push_ms"])
+    stats["duration_ms"] = round((time.perf_counter() - cycle_started) * 1000, 2)
+    stats["timestamp"] = int(time.time())
+    return stats
+
+def epoch_seconds(value):
+    """Normalise an epoch timestamp sent by the app (seconds or milliseconds) to seconds."""
+    if not value or value <= 0:
+        return None
+    return value / 1000 if value > 100_000_000_000 else float(value)
+
+class PollScheduler:
+    """Per-train poll timer kept in a min-heap of next-poll times.
+
+    Every train gets its own interval from its timetable (far from departure it
+    is polled rarely), the minutes to the next stop and how often its snapshot
+    changed recently; intervals are jittered so trains registered together do
+    not stay in lockstep. Heap entries whose due time no longer matches the
+    train's state are stale and skipped lazily.
+    """
+
+    def __init__(self, min_interval=10, max_interval=300, jitter=0.1):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.trains = {}
+        self._heap = []
+        self.lag = 0.0
+
+    def _push(self, key, due):
+        self.trains[key]["due"] = due
+        heapq.heappush(self._heap, (due, key))
+
+    def sync(self, trains, now, spread=1.0):
+        """Track newly subscribed trains (a set of keys), first polled at a random time
+        within `spread` seconds, and forget unsubscribed ones."""
+        for key in trains:
+            if key not in self.trains:
+                self.trains[key] = {"due": None, "interval": self.min_interval, "change_rate": 0.0, "snapshot": None, "last_success": now}
+                self._push(key, now + random.uniform(0, spread))
+        for key in [key for key in self.trains if key not in trains]:
+            del self.trains[key]
+
+    def pop_due(self, now):
+        due = []
+        lag = 0.0
+        while self._heap and self._heap[0][0] <= now:
+            due_at, key = heapq.heappop(self._heap)
+            state = self.trains.get(key)
+            if state is None or state["due"] != due_at:
+                continue
+            due.append(key)
+            lag = max(lag, now - due_at)
+        self.lag = lag
+        return due
+
+    def next_due(self):
+        return self._heap[0][0] if self._heap else None
+
+    def reset(self, now):
+        """Rebuild the heap with every tracked train due within a second, e.g. after
+        the polling task died holding trains it had popped but not rescheduled."""
+        self._heap = []
+        for key in self.trains:
+            self._push(key, now + random.uniform(0, 1))
+
+    def stale_trains(self, now, after):
+        """Trains without a successful fetch for `after` seconds or three of their intervals."""
+        return [
+            key for key, state in self.trains.items()
+            if now - state["last_success"] > max(after, 3 * state["interval"])
+        ]
+
+    def interval_for(self, activities, snapshot, change_rate, now):
+        departures = [t for t in (epoch_seconds(a.get("orarioPartenza")) for a in activities) if t]
+        departure = min(departures) if departures else None
+        if departure is not None and departure - now > 2 * 3600:
+            return self.max_interval
+        if departure is not None and departure - now > 30 * 60:
+            interval = 60.0
+        else:
+            minutes = snapshot.tempoProssimaStazione if snapshot else None
+            if minutes is None or minutes > 10:
+                interval = self.min_interval * 3
+            elif minutes > 2:
+                interval = self.min_interval * 2
+            else:
+                interval = self.min_interval
+        # Trains whose state keeps changing are polled up to twice as often, static ones less
+        interval *= 1.5 - change_rate
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def reschedule(self, key, activities, snapshot, now):
+        state = self.trains.get(key)
+        if state is None:
+            return
+        if snapshot is not None:
+            changed = state["snapshot"] is not None and snapshot != state["snapshot"]
+            state["change_rate"] = 0.7 * state["change_rate"] + 0.3 * (1.0 if changed else 0.0)
+            state["snapshot"] = snapshot
+            state["last_success"] = now
+        interval = self.interval_for(activities, state["snapshot"], state["change_rate"], now)
+        state["interval"] = interval
+        self._push(key, now + interval * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+scheduler = PollScheduler(POLL_MIN_INTERVAL, POLL_MAX_INTERVAL, POLL_JITTER)
+
+def end_payload(content_state, now):
+    """An `end` push dismissing the Live Activity right away."""
+    return encode_payload("end", now, content_state, b',"dismissal-date":%d' % now)
+
+def retire_finished_activities(key, now):
+    """Drop the activities of train `key` whose train arrived more than ACTIVITY_RETIRE_GRACE
+    seconds ago, counting the delay of its latest snapshot. Checked when the train comes due,
+    so it costs nothing between polls. Returns the (token, content-state) pairs whose Live
+    Activities need an `end` push."""
+    retired = []
+    state = scheduler.trains.get(key)
+    snapshot = state["snapshot"] if state else None
+    for token in list(store.by_train.get(key, ())):
+        data = active_activities[token]
+        # orarioArrivo is the full arrival time; dataArrivo may be the arrival day at midnight
+        arrivals = [t for t in (epoch_seconds(data.get("orarioArrivo")), epoch_seconds(data.get("dataArrivo"))) if t]
+        if not arrivals:
+            continue
+        arrival = max(arrivals)
+        try:
+            delay = int((snapshot.ritardo if snapshot is not None else data.get("ritardo")) or 0)
+        except (TypeError, ValueError):
+            delay = 0
+        if now <= arrival + max(delay, 0) * 60 + ACTIVITY_RETIRE_GRACE:
+            continue
+        fields = snapshot.as_dict() if snapshot is not None else dict(zip(SNAPSHOT_FIELDS, data.snapshot))
+        retired.append((token, ContentState(data.fragment(), *encode_snapshot(fields))))
+        store.remove(token)
+        last_sent.pop(token, None)
+        logger.info("Retired activity for token %s: train %s arrived", short_token(token), data.get('numeroTreno'))
+    return retired
+
+def forget_ended(token):
+    """Drop the APNs backoff of a token whose `end` push is settled, unless it is still
+    queued or the token has started another activity meanwhile."""
+    if token not in apns_retries and not active_activities.get(token):
+        apns_backoff.forget(token)
+
+async def send_end_push(token, content_state):
+    """Send the `end` push of an activity already removed from the store."""
+    async with shared_slots("apns", APNS_CONCURRENCY):
+        result = await send_push_notification(token, end_payload(content_state, int(time.time())))
+    forget_ended(token)
+    return result
+
+async def end_retired_activities(retired):
+    """Send the `end` push of each retired activity, so it does not stay frozen on the device."""
+
+    async def end(token, content_state):
+        result = await send_end_push(token, content_state)
+        logger.info("End retired activity for %s: %s", short_token(token), result.get("status"))
+
+    await asyncio.gather(*(end(token, content_state) for token, content_state in retired))
+
+def record_poll(key, stats):
+    TRAIN_POLL_SECONDS.observe(stats["duration_ms"] / 1000)
+    CYCLE_TRAINS.inc("fetched", amount=stats["upstream_fetches"])
+    CYCLE_TRAINS.inc("error", amount=stats["fetch_errors"])
+    CYCLE_TRAINS.inc("timeout", amount=stats["timeouts"])
+    CYCLE_TRAINS.inc("circuit_open", amount=stats["circuit_open"])
+    CYCLE_PUSHES.inc("sent", amount=stats["pushes"] - stats["push_errors"])
+    CYCLE_PUSHES.inc("error", amount=stats["push_errors"])
+    CYCLE_PUSHES.inc("skipped", amount=stats["skipped"])
+    CYCLE_PUSHES.inc("backed_off", amount=stats["backed_off"])
+    cycle_stats["polls"] += 1
+    cycle_stats["last_poll"] = stats
+    cycle_stats["totals"]["trains_fetched"] += stats["upstream_fetches"]
+    cycle_stats["totals"]["tokens_served"] += stats["tokens"]
+    cycle_stats["totals"]["sent"] += stats["pushes"]
+    cycle_stats["totals"]["sent_low_priority"] += stats["pushes_low_priority"]
+    cycle_stats["totals"]["skipped"] += stats["skipped"]
+    now = time.time()
+    recent_polls.append((now, key, stats["upstream_fetches"], stats["tokens"], stats["pushes"], stats["skipped"]))
+    while recent_polls[0][0] < now - CYCLE_WINDOW:
+        recent_polls.popleft()
+
+async def poll_train(key, train_tokens):
+    """Update one due train (`train_tokens` is a copy of its tokens) and schedule its next
+    poll once it is done."""
+    snapshots = {}
+    try:
+        stats = await run_update_cycle({key: train_tokens}, snapshots)
+        record_poll(key, stats)
+        logger.debug("Polled %s train %s in %sms for %d tokens, %d pushes sent, %d skipped",
+                     key[0], key[1], stats['duration_ms'], stats['tokens'], stats['pushes'], stats['skipped'])
+    finally:
+        activities = [active_activities[token] for token in train_tokens if active_activities.get(token)]
+        scheduler.reschedule(key, activities, snapshots.get(key), time.time())
+
 async def periodic_updates():
-    while True:
-        logger.info(f"Running periodic updates for {len(active_activities)} activities")
-        for token, data in list(active_activities.items()):
+    # Every due train is polled by its own task, so a slow train never holds back the others;
+    # the shared upstream and APNs slots bound how many run at once
+    polling = {}
+    # `end` pushes of retired activities
+    ending = set()
+    # Last trains_version() the scheduler was synced at: a wake-up only costs the due trains
+    synced = None
+    try:
+        # Shutdown lets the polls in progress finish, then the loop ends before starting more
+        while not lifecycle.stopping:
+            periodic_watchdog.beat()
+            now = time.time()
+            if trains_version() != synced:
+                synced = trains_version()
+                scheduler.sync(owned_trains(), now)
+            due = scheduler.pop_due(now)
+
+            retired = []
+            started = 0
+            for key in due:
+                if key in polling:
+                    continue  # Rescheduled when its current poll ends
+                retired.extend(retire_finished_activities(key, now))
+                train_tokens = store.by_train.get(key)
+                if not train_tokens:
+                    continue  # Every activity retired; the next sync forgets the train
+                task = asyncio.create_task(poll_train(key, list(train_tokens)))
+                polling[key] = task
+                task.add_done_callback(lambda _, key=key: polling.pop(key, None))
+                started += 1
+            if retired:
+                task = asyncio.create_task(end_retired_activities(retired))
+                ending.add(task)
+                task.add_done_callback(ending.discard)
+            cycle_stats["scheduler"] = {
+                "trains": len(scheduler.trains),
+                "polling": len(polling),
+                "lag_seconds": round(scheduler.lag, 3),
+                "retired": cycle_stats.get("scheduler", {}).get("retired", 0) + len(retired)
+            }
+            if started:
+                logger.debug("Polling %d of %d trains for %d activities", started, len(scheduler.trains), len(active_activities))
+
+            # Wake for the next due train, but at least every tick to pick up new registrations
+            next_due = scheduler.next_due()
+            delay = SCHEDULER_TICK if next_due is None else min(max(next_due - time.time(), 0.05), SCHEDULER_TICK)
+            await asyncio.sleep(delay)
+        if polling or ending:
+            await asyncio.gather(*polling.values(), *ending, return_exceptions=True)
+    finally:
+        # Cancelled by the watchdog or at the end of the shutdown drain
+        for task in [*polling.values(), *ending]:
+            task.cancel()
+
+async def push_train_update(update: TrainUpdate):
+    """Store an activity update and push it to its Live Activity."""
+    # Store the update with all fields
+    update_dict = update.dict()
+    
+    # Store the updated data
+    record = store.put(update.push_token, update_dict)
+    
+    # Encode the content-state (everything but the push_token) for APNs
+    content_state = ContentState(record.fragment(), *encode_snapshot(update_dict))
+    current_time = int(time.time())
+    payload = encode_payload("update", current_time, content_state, UPDATE_PAYLOAD_EXTRA)
+    
+    result = await send_push_notification(update.push_token, payload)
+    if result.get("status") == "success":
+        remember_sent(update.push_token, content_state, current_time)
+    return result
+
+def check_batch_size(items):
+    if len(items) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"Batch of {len(items)} items exceeds the limit of {MAX_BATCH_SIZE}")
+
+STALE_AFTER = float(os.environ.get("STALE_AFTER", "120"))
+
+def stale_activities():
+    now = time.time()
+    return sum(len(store.by_train.get(key, ())) for key in scheduler.stale_trains(now, STALE_AFTER))
+
+metrics.register(Gauge("trainss_active_activities", "Activities with train data", lambda: len(active_activities)))
+metrics.register(Gauge("trainss_registered_tokens", "Registered push tokens", lambda: len(tokens)))
+metrics.register(Gauge("trainss_scheduled_trains", "Trains tracked by the poll scheduler", lambda: len(scheduler.trains)))
+metrics.register(Gauge("trainss_scheduler_lag_seconds", "How late the last due trains were polled", lambda: scheduler.lag))
+metrics.register(Gauge("trainss_stale_activities", "Activities whose train has not been fetched successfully recently", stale_activities))
+metrics.register(Gauge("trainss_apns_retry_queue_depth", "Pushes waiting in the APNs retry queue", lambda: len(apns_retries)))
+metrics.register(Gauge("trainss_apns_tokens_in_backoff", "Tokens in APNs backoff", lambda: apns_backoff.state(time.time())["tokens_in_backoff"]))
+metrics.register(Gauge("trainss_store_dirty", "Activity changes waiting to be written to storage", store.pending_writes))
+metrics.register(Gauge(
+    "trainss_upstream_cache", "Upstream cache counters",
+    lambda: [({"counter": k}, v) for k, v in upstream_cache.stats().items()]
+))
+CIRCUIT_STATES = {"closed": 0, "half_open": 1, "open": 2}
+metrics.register(Gauge(
+    "trainss_upstream_circuit_state", "Upstream circuit per provider: 0 closed, 1 half-open, 2 open",
+    lambda: [({"provider": provider}, CIRCUIT_STATES[guard.breaker.state]) for provider, guard in upstream_guards.items()]
+))
+
+# train event stream
+STREAM_QUEUE_SIZE = int(os.environ.get("STREAM_QUEUE_SIZE", "256"))
+STREAM_MAX_SUBSCRIBERS = int(os.environ.get("STREAM_MAX_SUBSCRIBERS", "64"))
+STREAM_KEEPALIVE = float(os.environ.get("STREAM_KEEPALIVE", "15"))
+# Shared secret for GET /stream; the stream carries every polled train, so it is off until one is set
+STREAM_TOKEN = os.environ.get("STREAM_TOKEN")
+
+STREAM_EVENTS = metrics.register(Counter(
+    "trainss_stream_events_total", "Train events published to stream subscribers", ("event",)))
+STREAM_DROPPED = metrics.register(Counter(
+    "trainss_stream_dropped_total", "Train events dropped because a subscriber fell behind"))
+
+class StreamSubscription:
+    """Bounded event queue of one /stream client; when full, the oldest event makes room."""
+
+    def __init__(self, trains=None, maxsize=STREAM_QUEUE_SIZE):
+        # (provider, numeroTreno) pairs, numeroTreno alone for any provider, or None for every train
+        self.trains = trains
+        self.queue = deque(maxlen=maxsize)
+        self.ready = asyncio.Event()
+        self.dropped = 0
+
+    def wants(self, provider, train_number):
+        return self.trains is None or (provider, train_number) in self.trains or train_number in self.trains
+
+    def put(self, event):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+            STREAM_DROPPED.inc()
+        self.queue.append(event)
+        self.ready.set()
+
+    async def get(self, timeout):
+        """Next encoded event, or None when nothing arrived within timeout."""
+        if not self.queue:
+            self.ready.clear()
             try:
-                if not data:  # Skip if no data is available
-                    logger.info(f"No data available for token {token}")
-                    continue
-                    
-                # Create a clean payload without the push_token
-                content_state = data.copy()
-                if 'push_token' in content_state:
-                    del content_state['push_token']
-
-                # Payload overwriting
-                if content_state["provider"] == "Trenitalia":
-                    content_state["stazioneUltimoRilevamento"] = fetch_parameter('stazioneUltimoRilevamento',content_state['numeroTreno'])
-                    content_state["orarioUltimoRilevamento"] = fetch_parameter('oraUltimoRilevamento',content_state['numeroTreno'])
-                    content_state["ritardo"] = fetch_parameter('ritardo', content_state['numeroTreno'])
-                    content_state["prossimaStazione"] = fetch_fermate_info("prossima_stazione", content_state['numeroTreno'])
-                    content_state["prossimoBinario"] = fetch_fermate_info("prossimo_binario", content_state['numeroTreno'])
-                    content_state["tempoProssimaStazione"] = fetch_fermate_info("tempo_prossima_stazione", content_state['numeroTreno'])
-                else:
-                    content_state["stazioneUltimoRilevamento"] = fetch_parameter_italo('stazioneUltimoRilevamento',content_state['numeroTreno'])
-                    content_state["orarioUltimoRilevamento"] = fetch_parameter_italo('orarioUltimoRilevamento',content_state['numeroTreno'])
-                    content_state["ritardo"] = fetch_parameter_italo('ritardo', content_state['numeroTreno'])
-                    content_state["prossimaStazione"] = fetch_parameter_italo("prossimaStazione", content_state['numeroTreno'])
-                    content_state["prossimoBinario"] = fetch_parameter_italo("prossimoBinario", content_state['numeroTreno'])
-                    content_state["tempoProssimaStazione"] = fetch_parameter_italo("tempoProssimaStazione", content_state['numeroTreno'])
-
-                current_time = int(time.time())
-                payload = {
-                    "aps": {
-                        "timestamp": current_time,
-                        "event": "update",
-                        "content-state": content_state,
-                        "relevance-score": 100.0
-                    }
-                }
-                
-                logger.info(f"Periodic update payload for token {token}: {json.dumps(payload, indent=2)}")
-                result = await send_push_notification(token, payload)
-                logger.info(f"Periodic update result: {result}")
-                
-                # If there was an error, log it but continue with other tokens
-                if result.get("status") == "error":
-                    logger.error(f"Error sending update to {token}: {result.get('detail')}")
-            except Exception as e:
-                logger.error(f"Error processing update for token {token}: {str(e)}")
-        
-        logger.info("Sleeping for 10 seconds before next update cycle")
-        await asyncio.sleep(10)
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self.queue.popleft()
+
+class TrainEventHub:
+    """Publishes the snapshots polled by periodic_updates to internal /stream subscribers.
+
+    A poll that changes a train publishes a `snapshot` event with its parsed state,
+    followed by a `change` event listing the fields that moved since the last one.
+    Events are encoded once and shared by every subscriber; a new subscriber is
+    first sent the latest snapshot of each train it follows.
+    """
+
+    def __init__(self, max_trains=2000):
+        self.max_trains = max_trains
+        self.subscribers = set()
+        self.sequence = 0
+        # (provider, numeroTreno) -> latest snapshot event, in LRU order
+        self._latest = OrderedDict()
+        self._previous = {}
+
+    def _encode(self, event, body):
+        self.sequence += 1
+        STREAM_EVENTS.inc(event)
+        return b"id: %d\nevent: %s\ndata: %s\n\n" % (self.sequence, event.encode(), dumps(body))
+
+    def publish(self, provider, train_number, snapshot, now_ms):
+        key = (provider, str(train_number))
+        values = snapshot.as_dict()
+        previous = self._previous.get(key)
+        if previous == values:
+            # Same document served again from the upstream cache, or nothing moved
+            return
+        self._previous[key] = values
+
+        train = {"provider": provider, "numeroTreno": key[1], "timestamp": now_ms}
+        events = [self._encode("snapshot", dict(train, eta_ms=snapshot.eta_ms, snapshot=values))]
+        self._latest[key] = events[0]
+        self._latest.move_to_end(key)
+        while len(self._latest) > self.max_trains:
+            stale, _ = self._latest.popitem(last=False)
+            self._previous.pop(stale, None)
+
+        if previous is not None:
+            changes = {field: [previous.get(field), value] for field, value in values.items() if previous.get(field) != value}
+            if changes:
+                events.append(self._encode("change", dict(train, changes=changes)))
+
+        for subscription in self.subscribers:
+            if subscription.wants(*key):
+                for event in events:
+                    subscription.put(event)
+
+    def subscribe(self, trains=None):
+        subscription = StreamSubscription(trains)
+        for key, event in self._latest.items():
+            if subscription.wants(*key):
+                subscription.put(event)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscribers.discard(subscription)
+
+    def state(self):
+        return {
+            "subscribers": len(self.subscribers),
+            "trains": len(self._latest),
+            "events": self.sequence,
+            "queued": sum(len(s.queue) for s in self.subscribers),
+            "dropped": sum(s.dropped for s in self.subscribers)
+        }
+
+train_events = TrainEventHub(max_trains=upstream_cache.max_entries)
+metrics.register(Gauge("trainss_stream_subscribers", "Connected /stream subscribers", lambda: len(train_events.subscribers)))
+
+def stream_filter(trains, provider):
+    """Subscription filter from the ?train=...&provider=... query parameters."""
+    if not trains:
+        return None
+    numbers = {n.strip() for value in trains for n in value.split(",") if n.strip()}
+    if provider:
+        return {(provider, n) for n in numbers}
+    return numbers
+
+async def stream_events(request, subscription):
+    """Encoded events of a subscription taken by the handler, which also unsubscribes it
+    in a background task in case this generator is never started."""
+    try:
+        # Tell EventSource clients how long to wait before reconnecting
+        yield b"retry: 5000\n\n"
+        while not await request.is_disconnected():
+            event = await subscription.get(STREAM_KEEPALIVE)
+            # A comment line keeps idle connections from being closed by proxies
+            yield b": keepalive\n\n" if event is None else event
+    finally:
+        train_events.unsubscribe(subscription)
+
+# readiness and watchdog
+WATCHDOG_INTERVAL = float(os.environ.get("WATCHDOG_INTERVAL", "10"))
+# A polling loop that has not come round for this long is considered stalled
+WATCHDOG_STALL_AFTER = float(os.environ.get("WATCHDOG_STALL_AFTER", str(4 * TRAIN_UPDATE_TIMEOUT)))
+READY_MAX_SCHEDULER_LAG = float(os.environ.get("READY_MAX_SCHEDULER_LAG", "60"))
+
+class Watchdog:
+    """Keeps a background loop running: restarts it when its task has ended or
+    when it has not called `beat()` for `stall_after` seconds."""
+
+    def __init__(self, name, factory, stall_after, on_restart=None):
+        self.name = name
+        self.factory = factory
+        self.stall_after = stall_after
+        self.on_restart = on_restart
+        self.task = None
+        self.last_beat = None
+        self.restarts = 0
+        self.stopped = False
+
+    def start(self):
+        self.last_beat = time.monotonic()
+        self.task = asyncio.create_task(self.factory())
+
+    def beat(self):
+        self.last_beat = time.monotonic()
+
+    def problem(self, now):
+        """Why the loop needs a restart, or None while it is healthy."""
+        if self.task is None:
+            return "not started"
+        if self.task.done():
+            if self.task.cancelled():
+                return "cancelled"
+            error = self.task.exception()
+            return f"exited: {error!r}" if error else "exited"
+        if now - self.last_beat > self.stall_after:
+            return f"no heartbeat for {now - self.last_beat:.1f}s"
+        return None
+
+    def stop(self):
+        """Stop restarting the loop and return its task, so shutdown can let it finish."""
+        self.stopped = True
+        return self.task
+
+    async def run(self, interval):
+        while not self.stopped:
+            await asyncio.sleep(interval)
+            if self.stopped:
+                break
+            problem = self.problem(time.monotonic())
+            if problem is None or problem == "not started":
+                continue
+            logger.error(f"Restarting {self.name}: {problem}")
+            WATCHDOG_RESTARTS.inc(self.name)
+            self.task.cancel()
+            self.restarts += 1
+            if self.on_restart is not None:
+                self.on_restart()
+            self.start()
+
+    def state(self, now):
+        return {
+            "running": self.task is not None and not self.task.done(),
+            "seconds_since_heartbeat": None if self.last_beat is None else round(now - self.last_beat, 1),
+            "restarts": self.restarts
+        }
+
+periodic_watchdog = Watchdog(
+    "periodic_updates", periodic_updates, WATCHDOG_STALL_AFTER,
+    on_restart=lambda: scheduler.reset(time.time())
+)
+
+def readiness(now):
+    """Readiness checks, from state the server already keeps (no probe requests).
+
+    Not ready when the polling loop is stalled, the scheduler lags too far
+    behind or APNs is failing; unreachable upstreams only degrade readiness,
+    since restarting this instance would not bring them back.
+    """
+    loop = periodic_watchdog.state(time.monotonic())
+    loop["ok"] = loop["running"] and periodic_watchdog.problem(time.monotonic()) is None
+
+    apns = apns_pool.state()
+    apns["ok"] = apns["connections"] > 0 and (
+        apns["last_error"] is None or (apns["last_ok"] or 0) > apns["last_error"]
+    )
+
+    lag = {"lag_seconds": round(scheduler.lag, 3), "max_lag_seconds": READY_MAX_SCHEDULER_LAG}
+    lag["ok"] = scheduler.lag <= READY_MAX_SCHEDULER_LAG
+
+    upstreams = {}
+    for host, state in upstream_reachability.items():
+        upstreams[host] = dict(state, reachable=state["last_error"] is None or (state["last_ok"] or 0) > state["last_error"])
+    circuits = {provider: guard.state(time.monotonic()) for provider, guard in upstream_guards.items()}
+
+    if not (loop["ok"] and apns["ok"] and lag["ok"]):
+        status = "not_ready"
+    elif not all(state["reachable"] for state in upstreams.values()) or any(
+            circuit["state"] != "closed" for circuit in circuits.values()):
+        status = "degraded"
+    else:
+        status = "ready"
+    return {
+        "status": status,
+        "timestamp": int(now),
+        "periodic_updates": loop,
+        "scheduler": lag,
+        "apns": apns,
+        "upstream": upstreams,
+        "circuits": circuits
+    }
 
 @app.post("/register-token")
 async def register_token(registration: TokenRegistration):
     """Register a push token for a train"""
     try:
-        logger.info(f"Registering token for train {registration.train_id}")
-        tokens[registration.push_token] = registration.train_id
-        active_activities[registration.push_token] = {}
-        logger.info(f"Current tokens: {tokens}")
+        store.register(registration.push_token, registration.train_id)
+        logger.info("Registered token %s for train %s (%d tokens)", short_token(registration.push_token), registration.train_id, len(tokens))
         return {"status": "Token registered"}
     except Exception as e:
         logger.error(f"Error registering token: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/register-tokens")
+async def register_tokens(registrations: List[TokenRegistration]):
+    """Register many push tokens in one request"""
+    check_batch_size(registrations)
+    results = []
+    for registration in registrations:
+        try:
+            store.register(registration.push_token, registration.train_id)
+            results.append({"push_token": registration.push_token, "status": "Token registered"})
+        except Exception as e:
+            logger.error("Error registering token %s: %s", short_token(registration.push_token), e)
+            results.append({"push_token": registration.push_token, "status": "error", "detail": str(e)})
+    logger.info(f"Registered {len(registrations)} tokens in batch")
+    return {"results": results}
+
 @app.post("/update-train-activity")
 async def update_train_activity(update: TrainUpdate):
     """Update train activity status"""
     try:
-        logger.info(f"Received update for token: {update.push_token}")
-        
-        if update.push_token not in tokens:
-            logger.error(f"Token not found. Available tokens: {tokens}")
+        if not await store.lookup(update.push_token):
+            logger.error("Token not found: %s", short_token(update.push_token))
             raise HTTPException(status_code=400, detail="Token not found")
             
-        # Store the update with all fields
-        update_dict = update.dict()
-        
-        # Store the updated data
-        active_activities[update.push_token] = update_dict
-        logger.info(f"Updated active_activities for token {update.push_token}")
-        
-        # Create a clean payload without the push_token
-        content_state = update_dict.copy()
-        if 'push_token' in content_state:
-            del content_state['push_token']
-        
-        # Create payload for APNs
-        current_time = int(time.time())
-        payload = {
-            "aps": {
-                "timestamp": current_time,
-                "event": "update",
-                "content-state": content_state,
-                "relevance-score": 100.0
-            }
-        }
-        
-        result = await send_push_notification(update.push_token, payload)
-        logger.info(f"Update result: {result}")
+        async with shared_slots("apns", APNS_CONCURRENCY):
+            result = await push_train_update(update)
+        logger.info("Update for %s: %s", short_token(update.push_token), result.get("status"))
         return result
     except Exception as e:
         logger.error(f"Error processing update: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/update-train-activities")
+async def update_train_activities(updates: List[TrainUpdate]):
+    """Update many train activities in one request, sending their pushes concurrently"""
+    check_batch_size(updates)
+    # The process-wide APNs slots: concurrent batches and the periodic updates share one limit
+    apns_slots = shared_slots("apns", APNS_CONCURRENCY)
+
+    async def apply(update):
+        try:
+            if not await store.lookup(update.push_token):
+                return {"push_token": update.push_token, "status": "error", "code": 400, "detail": "Token not found"}
+            async with apns_slots:
+                result = await push_train_update(update)
+            return dict(result, push_token=update.push_token)
+        except Exception as e:
+            logger.error("Error processing update for token %s: %s", short_token(update.push_token), e)
+            return {"push_token": update.push_token, "status": "error", "detail": str(e)}
+
+    results = await asyncio.gather(*(apply(update) for update in updates))
+    failed = sum(1 for result in results if result.get("status") != "success")
+    logger.info(f"Processed batch of {len(updates)} updates ({failed} failed)")
+    return {"results": results}
+
 @app.post("/end-train-activity")
 async def end_train_activity(update: TrainUpdate):
     """Endpoint to end a Live Activity"""
     try:
-        logger.info(f"Ending activity for token: {update.push_token}")
         
         if update.push_token in active_activities:
-            del active_activities[update.push_token]
-            logger.info(f"Removed token {update.push_token} from active activities")
+            store.end(update.push_token)
+            logger.info("Removed token %s from active activities", short_token(update.push_token))
+        last_sent.pop(update.push_token, None)
 
-        # Create a clean payload without the push_token
-        content_state = update.dict()
-        if 'push_token' in content_state:
-            del content_state['push_token']
+        # Encode the content-state (everything but the push_token) for APNs
+        content_state = ContentState.from_dict(update.dict())
 
-        current_time = int(time.time())
-        payload = {
-            "aps": {
-                "timestamp": current_time,
-                "event": "end",
-                "content-state": content_state,
-                "dismissal-date": current_time  # End immediately
-            }
-        }
-
-        result = await send_push_notification(update.push_token, payload)
-        logger.info(f"End activity result: {result}")
+        # End immediately
+        result = await send_end_push(update.push_token, content_state)
+        logger.info("End activity for %s: %s", short_token(update.push_token), result.get("status"))
         return result
     except Exception as e:
         logger.error(f"Error ending activity: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus metrics"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
@@ -580,6 +2835,39 @@ async def health_check():
         "active_activities": len(active_activities)
     }
 
+@app.get("/ready")
+async def readiness_check():
+    """Readiness endpoint: 200 when ready or degraded, 503 when not ready"""
+    report = readiness(time.time())
+    if report["status"] == "not_ready":
+        return JSONResponse(report, status_code=503)
+    return report
+
+@app.get("/stream")
+async def stream_endpoint(request: Request, train: Optional[List[str]] = Query(None), provider: Optional[str] = None):
+    """Server-Sent Events of the train snapshots and changes seen by periodic updates.
+    Filter with ?train=9544&train=8901 (or train=9544,8901) and optionally provider=Italo."""
+    if not STREAM_TOKEN:
+        raise HTTPException(status_code=404, detail="Stream is disabled: STREAM_TOKEN is not set")
+    if not hmac.compare_digest(request.headers.get("authorization", "").encode(), f"Bearer {STREAM_TOKEN}".encode()):
+        raise HTTPException(status_code=401, detail="Invalid stream token")
+    if len(train_events.subscribers) >= STREAM_MAX_SUBSCRIBERS:
+        raise HTTPException(status_code=503, detail=f"Stream is at its limit of {STREAM_MAX_SUBSCRIBERS} subscribers")
+    # Subscribe here rather than in the generator, so the subscriber count covers
+    # every response already handed out and the next request sees the cap
+    subscription = train_events.subscribe(stream_filter(train, provider))
+    return StreamingResponse(
+        stream_events(request, subscription),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(train_events.unsubscribe, subscription)
+    )
+
+@app.get("/debug/stream")
+async def debug_stream():
+    """Debug endpoint to view stream subscribers and queued events"""
+    return train_events.state()
+
 @app.post("/debug")
 async def debug_endpoint(data: dict):
     """Debug endpoint to log incoming data"""
@@ -589,36 +2877,197 @@ async def debug_endpoint(data: dict):
 @app.get("/debug/tokens")
 async def debug_tokens():
     """Debug endpoint to view registered tokens"""
-    return {"tokens": tokens, "activities": active_activities}
+    return {
+        "tokens": tokens,
+        "activities": {token: data.as_dict() if data else data for token, data in active_activities.items()}
+    }
+
+@app.get("/debug/cycle")
+async def debug_cycle():
+    """Debug endpoint to view the periodic poll counters: totals, the last minute and the last poll"""
+    state = dict(cycle_stats, last_minute=recent_cycle(time.time()))
+    if shard is not None:
+        state["shard"] = shard.state()
+    return state
+
+@app.get("/debug/apns")
+async def debug_apns():
+    """Debug endpoint to view APNs outcomes, backoff and retry queue state"""
+    return dict(
+        apns_backoff.state(time.time()),
+        outcomes=apns_outcomes,
+        retry_queue=len(apns_retries),
+        retries_dropped=apns_retries.dropped,
+        pool=apns_pool.state()
+    )
+
+@app.get("/debug/cache")
+async def debug_cache():
+    """Debug endpoint to view upstream cache counts and the providers' rate limiter and circuit state"""
+    return {
+        "upstream": upstream_cache.stats(),
+        "station_codes": station_index.stats(),
+        "guards": {provider: guard.state(time.monotonic()) for provider, guard in upstream_guards.items()}
+    }
 
 @app.get("/debug/jwt")
 async def debug_jwt():
     """Debug endpoint to test JWT token generation"""
     try:
         token = await create_token()
-        return {"token": token}
+        return {
+            "token": token,
+            "issued_at": provider_tokens.issued_at,
+            "age_seconds": provider_tokens.age(),
+            "refresh_after_seconds": provider_tokens.refresh_after
+        }
     except Exception as e:
         logger.error(f"Error generating JWT token: {str(e)}")
         return {"error": str(e)}
 
+# lifecycle
+# Seconds shutdown waits for the cycle in progress and in-flight APNs requests before cancelling them
+SHUTDOWN_DRAIN_TIMEOUT = float(os.environ.get("SHUTDOWN_DRAIN_TIMEOUT", "15"))
+# Seconds over which the first polls of the trains restored at startup are spread
+STARTUP_POLL_SPREAD = float(os.environ.get("STARTUP_POLL_SPREAD", str(3 * POLL_MIN_INTERVAL)))
+
+class Lifecycle:
+    """Background tasks started with the app, and the flag that stops their loops.
+
+    Loops check `stopping` before scheduling more work; shutdown sets it, drains
+    the work already started within a deadline and then cancels what is left.
+    """
+
+    def __init__(self):
+        self.tasks = set()
+        self.stopping = False
+
+    def spawn(self, coro, name):
+        task = asyncio.create_task(coro, name=name)
+        self.tasks.add(task)
+        task.add_done_callback(self._finished)
+        return task
+
+    def _finished(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Background task {task.get_name()} failed: {task.exception()!r}")
+
+    async def drain(self, tasks, timeout):
+        """Wait up to timeout for tasks to end and for in-flight APNs requests to be
+        answered; returns whether everything finished in time."""
+        deadline = time.monotonic() + timeout
+        pending = [task for task in tasks if task is not None and not task.done()]
+        if pending:
+            _, pending = await asyncio.wait(pending, timeout=timeout)
+        while apns_pool.inflight and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        return not pending and not apns_pool.inflight
+
+    async def cancel(self, *tasks):
+        """Cancel every background task (and the given ones) and wait for them to unwind."""
+        tasks = [task for task in (*self.tasks, *tasks) if task is not None and not task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return len(tasks)
+
+lifecycle = Lifecycle()
+
 @app.on_event("startup")
 async def startup_event():
-    asyncio.create_task(ping_server())
+    store.restore()
+    # Resume change detection where the previous process left off
+    last_sent.update(store.restore_sent())
+    # End pushes the previous process left queued go out once their backoff is over
+    pending_ends = store.restore_pending_ends()
+    for token, payload, priority, apns_id, attempt, due in pending_ends:
+        apns_retries.push(token, payload, priority, apns_id, attempt, due)
+    lifecycle.spawn(store.flush_loop(STORE_FLUSH_INTERVAL), "store_flush")
+    if shard is not None:
+        await asyncio.to_thread(shard.heartbeat)
+        lifecycle.spawn(shard.run(WORKER_HEARTBEAT), "shard_heartbeat")
+        lifecycle.spawn(store.sync_loop(STORE_SYNC_INTERVAL), "store_sync")
+        logger.info(f"Sharded worker {shard.worker_id} started")
+    # Spread the first polls of the restored trains instead of fetching them all at once
+    scheduler.sync(owned_trains(), time.time(), spread=STARTUP_POLL_SPREAD)
+    logger.info(f"Scheduled {len(scheduler.trains)} trains over {STARTUP_POLL_SPREAD:g}s, {len(last_sent)} last pushes and {len(pending_ends)} end pushes restored")
 
     # Check if APNS_AUTH_KEY is set
     if not os.environ.get('APNS_AUTH_KEY'):
         logger.warning("APNS_AUTH_KEY environment variable is not set. Push notifications will not work!")
     else:
         logger.info("APNS_AUTH_KEY environment variable is set.")
+        try:
+            provider_tokens.refresh()
+        except Exception as e:
+            logger.error(f"Error creating APNs provider token: {str(e)}")
+    lifecycle.spawn(provider_tokens.refresh_loop(), "provider_token_refresh")
     
     # Log configuration
-    logger.info(f"Server configuration: TEAM_ID={TEAM_ID}, KEY_ID={KEY_ID}, BUNDLE_ID={BUNDLE_ID}")
+    logger.info(f"Server configuration: TEAM_ID={TEAM_ID}, KEY_ID={KEY_ID}, BUNDLE_ID={BUNDLE_ID}, LOG_FORMAT={LOG_FORMAT}")
     logger.info(f"APNs Host: {APNS_HOST}:{APNS_PORT}")
+    await apns_pool.start()
     
-    # Start periodic updates
-    asyncio.create_task(periodic_updates())
+    # Resolve the origin stations of the trains being followed before their first poll
+    lifecycle.spawn(station_index.prewarm(
+        data["numeroTreno"] for data in active_activities.values()
+        if data and data.get("provider") == "Trenitalia" and data.get("numeroTreno")
+    ), "station_prewarm")
+
+    lifecycle.spawn(apns_retry_loop(), "apns_retry")
+
+    # Start periodic updates under the watchdog
+    periodic_watchdog.start()
+    lifecycle.spawn(periodic_watchdog.run(WATCHDOG_INTERVAL), "watchdog")
     logger.info("Started periodic train updates task")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Stop scheduling: no new polls, retries or watchdog restarts
+    lifecycle.stopping = True
+    polling = periodic_watchdog.stop()
+    retrying = [task for task in lifecycle.tasks if task.get_name() == "apns_retry"]
+    started = time.monotonic()
+    drained = await lifecycle.drain([polling, *retrying], SHUTDOWN_DRAIN_TIMEOUT)
+    remaining = SHUTDOWN_DRAIN_TIMEOUT - (time.monotonic() - started)
+    if drained and remaining > 0:
+        # Retries that came due while the polls drained go out within the same deadline
+        try:
+            resent = await asyncio.wait_for(resend_due_retries(time.time()), remaining)
+            if resent:
+                logger.info(f"Sent {resent} due APNs retries")
+        except asyncio.TimeoutError:
+            drained = False
+    if drained:
+        logger.info(f"Drained in-flight pushes in {time.monotonic() - started:.2f}s")
+    else:
+        logger.warning(f"Drain deadline of {SHUTDOWN_DRAIN_TIMEOUT:g}s passed with {apns_pool.inflight} APNs requests in flight, cancelling")
+    cancelled = await lifecycle.cancel(polling)
+    logger.info(f"Stopped {cancelled} background tasks")
+
+    # The final flush first waits out a write the cancelled flush loop left running in its
+    # thread, so the checkpoint never begins a transaction on the connection mid-batch
+    await store.flush()
+    logger.info("Flushed activity store")
+    try:
+        saved = await store.checkpoint_sent(last_sent)
+        logger.info(f"Checkpointed last pushes for {saved} activities")
+        # Queued updates are superseded by the next process's first polls; `end` pushes are not
+        ends = await store.checkpoint_pending_ends(apns_retries.pending("end"))
+        logger.info(f"Saved {ends} unsent end pushes, dropped {len(apns_retries) - ends} queued retries")
+    except Exception as e:
+        logger.error(f"Error checkpointing last pushes: {str(e)}")
+    store.close()
+
+    await close_upstream_client()
+    logger.info("Closed upstream http client")
+    await apns_pool.close()
+    logger.info("Closed APNs connection pool")
+    if shard is not None:
+        shard.leave()
+        logger.info(f"Worker {shard.worker_id} left the shard ring")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000) 